@@ -0,0 +1,94 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class CacheEntry(object):
+    __slots__ = ('value', 'expires', 'etag', 'last_modified')
+
+    def __init__(self, value, expires, etag=None, last_modified=None):
+        self.value = value
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class DetailCache(object):
+    """TTL + LRU cache for detail objects, keyed by url.
+
+    Concurrent get() calls for the same key share a single fetch. Values are
+    deep-copied on the way out, callers are free to modify what they get.
+    Expired entries are kept (until evicted) so they can be revalidated
+    with a conditional request instead of being fetched again.
+    """
+
+    def __init__(self, ttl=60, max_size=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Get a value, fetching it if needed.
+
+            :param key: cache key (url)
+            :param fetch: callable(key, stale_entry) -> (value, etag, last_modified, cacheable);
+                          stale_entry is the expired CacheEntry or None; a value that isn't
+                          cacheable (e.g. an error response) is returned but not stored
+            :returns: a copy of the value
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry.value)
+            self.misses += 1
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._pending[key] = future
+
+        if not owner:
+            return copy.deepcopy(future.result())
+
+        try:
+            value, etag, last_modified, cacheable = fetch(key, entry)
+            if cacheable and value is not None:
+                self._store(key, CacheEntry(value, time.monotonic() + self.ttl, etag, last_modified))
+            future.set_result(value)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+        return copy.deepcopy(value)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
@@ -0,0 +1,167 @@
+import datetime
+import hashlib
+import json
+from .Snapshot import read_snapshot, write_snapshot
+
+
+class ChangeTracker(object):
+    """What the last successful sync saw in LDAP, to only import what changed since.
+
+    For every DN of every kind ('users', 'classes') the tracker keeps a
+    fingerprint of its attributes and a bit of data the importer wants back
+    later (a user's login, a class's name), plus a watermark: the highest
+    timestamp_attribute value seen. An importer asks check() for each entry
+    and only goes on with the changed ones; once it has gone through all
+    entries of a kind, the DNs it didn't see are deleted(). Nothing is
+    saved until commit(), which the importer calls after a successful sync.
+
+        :param path: where the state is kept, written like a Snapshot
+        :param timestamp_attribute: e.g. 'modifyTimestamp' to let the LDAP server
+                                    filter out entries older than the watermark
+        :param full: hand out every entry this time, still recording fingerprints
+
+    """
+
+    kind = 'ldap_changes'
+
+    def __init__(self, path, timestamp_attribute=None, full=False):
+        self.path = path
+        self.timestamp_attribute = timestamp_attribute
+        self.full = full
+        state = read_snapshot(path)
+        if state is None or state.get('kind') != type(self).kind \
+                or state.get('timestamp_attribute') != timestamp_attribute:
+            state = {}
+        self.entries = state.get('entries') or {}
+        self.watermark = type(self).generalized_time(state.get('watermark'))
+        self._watermark = self.watermark
+        self._seen = {}
+        self._pending = {}
+        self._finished = set()
+        self._committed_deletions = {}
+
+    @staticmethod
+    def fingerprint(attributes, ignore=()):
+        """Digest of an ldap3 attributes dict, independent of attribute and value order."""
+        normalized = {}
+        for name, value in attributes.items():
+            if name in ignore:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            normalized[name.lower()] = sorted(
+                x.hex() if isinstance(x, (bytes, bytearray)) else str(x) for x in value)
+        data = json.dumps(normalized, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return hashlib.sha1(data).hexdigest()
+
+    @staticmethod
+    def generalized_time(value):
+        """A timestamp as LDAP generalized time text (e.g. 20240101100000Z), as filters want it.
+
+        ldap3 hands out a datetime when it knows the schema, the raw text otherwise.
+        """
+        if value is None:
+            return None
+        if isinstance(value, (bytes, bytearray)):
+            value = value.decode('utf-8')
+        if isinstance(value, str):
+            if value[4:5] != '-':
+                return value
+            # A watermark saved as str(datetime) by an earlier version
+            value = datetime.datetime.fromisoformat(value)
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return value.strftime('%Y%m%d%H%M%SZ')
+
+    def can_filter(self):
+        """True if the LDAP search itself can skip entries older than the watermark."""
+        return self.timestamp_attribute is not None and self.watermark is not None and not self.full
+
+    def seen(self, kind, dn):
+        """Note that dn still exists, without looking at its attributes."""
+        self._seen.setdefault(kind, set()).add(dn)
+
+    def check(self, kind, dn, attributes, **data):
+        """Record an entry; True if it's new or changed since the last sync.
+
+            :param attributes: ldap3 attributes of the entry
+            :param data: kept with the entry, see get()
+
+        """
+        self.seen(kind, dn)
+        timestamp = None
+        if self.timestamp_attribute is not None:
+            timestamp = attributes.get(self.timestamp_attribute)
+            if isinstance(timestamp, list):
+                timestamp = timestamp[0] if timestamp else None
+            if timestamp is not None:
+                # In UTC with the same number of digits, generalized times compare fine as text
+                timestamp = type(self).generalized_time(timestamp)
+                if self._watermark is None or timestamp > self._watermark:
+                    self._watermark = timestamp
+        fingerprint = type(self).fingerprint(
+            attributes, ignore=(self.timestamp_attribute, ) if self.timestamp_attribute else ())
+        self._pending.setdefault(kind, {})[dn] = {'fingerprint': fingerprint, 'data': data}
+        stored = self.entries.get(kind, {}).get(dn)
+        return self.full or stored is None or stored['fingerprint'] != fingerprint
+
+    def finish(self, kind):
+        """Every entry of kind has been seen, so what's missing is gone."""
+        self._finished.add(kind)
+
+    def deleted(self, kind):
+        """DNs of the last sync that weren't seen this time, with their data.
+
+        Only known once the importer has gone through all entries of kind;
+        after commit(), these are the deletions it committed.
+        """
+        if kind not in self._finished:
+            return dict(self._committed_deletions.get(kind, {}))
+        seen = self._seen.get(kind, set())
+        return {dn: stored['data'] for dn, stored in self.entries.get(kind, {}).items() if dn not in seen}
+
+    def get(self, kind, dn):
+        """Data stored with dn, from this run or the last sync."""
+        pending = self._pending.get(kind, {}).get(dn)
+        if pending is not None:
+            return pending['data']
+        stored = self.entries.get(kind, {}).get(dn)
+        return stored['data'] if stored is not None else None
+
+    def commit(self, failed=()):
+        """Save what this run saw as synced.
+
+            :param failed: DNs whose sync failed; they are handed out again next time
+
+        """
+        failed = set(failed)
+        entries = {}
+        deletions = {}
+        for kind in set(self.entries) | set(self._pending):
+            stored = self.entries.get(kind, {})
+            if kind in self._finished:
+                deletions[kind] = {dn: data for dn, data in self.deleted(kind).items() if dn not in failed}
+                # Deletions that failed to be handled are reported again next time
+                current = {dn: x for dn, x in stored.items() if dn in self._seen.get(kind, set()) or dn in failed}
+            else:
+                current = dict(stored)
+            for dn, entry in self._pending.get(kind, {}).items():
+                if dn not in failed:
+                    current[dn] = entry
+                elif dn in current and current[dn]['fingerprint'] == entry['fingerprint']:
+                    # Failed this time, so it must count as changed next time
+                    del current[dn]
+            entries[kind] = current
+        write_snapshot(self.path, {
+            'kind': type(self).kind,
+            'timestamp_attribute': self.timestamp_attribute,
+            'watermark': self._watermark if not failed else self.watermark,
+            'entries': entries,
+        })
+        self.entries = entries
+        if not failed:
+            self.watermark = self._watermark
+        self._committed_deletions = deletions
+        self._seen = {}
+        self._pending = {}
+        self._finished = set()
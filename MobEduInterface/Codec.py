@@ -0,0 +1,73 @@
+"""JSON for request and response bodies.
+
+orjson is used when it's installed, the json module otherwise. Decoding
+errors are json.JSONDecodeError either way (orjson's is a subclass).
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_decoder = json.JSONDecoder()
+_whitespace = json.decoder.WHITESPACE
+
+
+def json_loads(data):
+    """Decode a JSON document, straight from response bytes or from a str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Encode obj as UTF-8 JSON bytes."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which json still handles
+            pass
+    return json.dumps(obj).encode('utf-8')
+
+
+def iter_json_array(data, stream_above=1 << 20):
+    """Yield the items of a JSON array one by one.
+
+    Each item is let go of once it has been yielded, so a caller that
+    converts items as they come never holds the whole array twice. Without
+    orjson, documents larger than stream_above bytes are also decoded one
+    item at a time; below that, decoding them whole is faster. Anything but
+    an array raises json.JSONDecodeError.
+
+        :param data: bytes or str
+
+    """
+    if orjson is not None or len(data) <= stream_above:
+        items = json_loads(data)
+        if not isinstance(items, list):
+            raise json.JSONDecodeError("Expecting an array", str(data[:20]), 0)
+        items.reverse()
+        while items:
+            yield items.pop()
+        return
+
+    text = data.decode('utf-8') if isinstance(data, (bytes, bytearray)) else data
+    idx = _whitespace.match(text, 0).end()
+    if text[idx:idx + 1] != '[':
+        raise json.JSONDecodeError("Expecting an array", text, idx)
+    idx = _whitespace.match(text, idx + 1).end()
+    if text[idx:idx + 1] == ']':
+        return
+    while True:
+        item, idx = _decoder.raw_decode(text, idx)
+        yield item
+        idx = _whitespace.match(text, idx).end()
+        if text[idx:idx + 1] == ']':
+            break
+        if text[idx:idx + 1] != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, idx)
+        idx = _whitespace.match(text, idx + 1).end()
+    if _whitespace.match(text, idx + 1).end() != len(text):
+        raise json.JSONDecodeError("Extra data", text, idx + 1)
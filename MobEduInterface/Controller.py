@@ -1,5 +1,18 @@
 import requests
+import functools
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .Cache import DetailCache
+from .Codec import iter_json_array, json_dumps, json_loads
+from .Executor import ImportExecutor
+from .Mapping import compile_mapping
+from .Metrics import EndpointClassifier, RequestMetrics
+from .Passwords import PasswordResult
+from .Records import UserRecord
+from .Snapshot import read_snapshot, write_snapshot
 
 
 class UserExists(Exception):
@@ -18,6 +31,10 @@ class OperationalError(Exception):
     pass
 
 
+class PruneThresholdExceeded(Exception):
+    pass
+
+
 class RequestFailedException(Exception):
     def __init__(self, code, response=None):
         super(RequestFailedException, self).__init__()
@@ -28,7 +45,64 @@ class RequestFailedException(Exception):
         return "RequestFailedException(code={})".format(self.code)
 
 
-class Controller(object):
+@functools.lru_cache(maxsize=4096)
+def _division_name(value):
+    # "10 A whatever" -> ("10", "A", "whatever"); split once per distinct name
+    # rather than once per class mapping lambda
+    return tuple(value.split(" "))
+
+
+class _AttributeRecorder(dict):
+    # Stand-in for a local object that remembers which attributes a mapping looks at.
+    # Every attribute exists and looks like "1 A", which keeps the class lambdas happy
+    def __init__(self):
+        super(_AttributeRecorder, self).__init__()
+        self.seen = set()
+
+    def __contains__(self, key):
+        self.seen.add(key)
+        return True
+
+    def __getitem__(self, key):
+        self.seen.add(key)
+        return "1 A"
+
+    def get(self, key, default=None):
+        return self[key]
+
+
+class _SchoolView(object):
+    # Mixed into a controller class by Controller.for_school: every attribute but
+    # managed_school is read from and written to the shared controller
+    _own_attributes = ('_shared', 'managed_school')
+
+    def __getattr__(self, name):
+        # Only called for attributes the view itself doesn't have
+        return getattr(object.__getattribute__(self, '_shared'), name)
+
+    def __setattr__(self, name, value):
+        if name in _SchoolView._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._shared, name, value)
+
+
+_school_view_classes = {}
+
+
+def _school_view_class(cls):
+    if cls not in _school_view_classes:
+        _school_view_classes[cls] = type('School' + cls.__name__, (_SchoolView, cls), {})
+    return _school_view_classes[cls]
+
+
+class BaseController(object):
+    """What Controller and AsyncController share: the server's urls and mappings,
+    the cached users, classes and schools with their indexes, and lookups in them.
+
+    Nothing here talks to the server; the controllers add that, each in its own way.
+    """
+
     root_url = '/'
     auth_url = '/api/authenticate'
     account_url = '/api/account'
@@ -44,6 +118,31 @@ class Controller(object):
     group_detail_url = '/api/userGroups/{group[id]}'
     activate_user_url = '/adm/users/activate'
 
+    # Names requests are counted under in self.metrics: (name, method, url attribute)
+    endpoints = (
+        ('authenticate', 'POST', 'auth_url'),
+        ('account', 'GET', 'account_url'),
+        ('users_page', 'GET', 'users_url'),
+        ('user_create', 'POST', 'user_url'),
+        ('user_update', 'PUT', 'user_url'),
+        ('user_activate', 'PUT', 'activate_user_url'),
+        ('user_detail', 'GET', 'user_detail_url'),
+        ('user_delete', 'DELETE', 'user_detail_url'),
+        ('classes_page', 'GET', 'classes_url'),
+        ('class_create', 'POST', 'class_url'),
+        ('class_update', 'PUT', 'class_url'),
+        ('class_detail', 'GET', 'class_detail_url'),
+        ('class_delete', 'DELETE', 'class_detail_url'),
+        ('schools', 'GET', 'school_url'),
+        ('group_create', 'POST', 'group_url'),
+        ('group_update', 'PUT', 'group_url'),
+        ('group_detail', 'GET', 'group_detail_url'),
+        ('group_delete', 'DELETE', 'group_detail_url'),
+    )
+
+    # Server-side cap on per_page, see Known_mobedu_bugs.md
+    page_size = 100
+
     default_student_roles = ["ROLE_STUDENT"]
     default_teacher_roles = ["ROLE_TEACHER"]
 
@@ -61,87 +160,829 @@ class Controller(object):
     }
 
     default_class_mappings = {
-        ('name', lambda x: " ".join(x['eline-division-name'].split(" ")[0:2]) if 'eline-division-name' in x else None),
-        ('parallel', lambda x: int(x['eline-division-name'].split(" ")[0]) if 'eline-division-name' in x else None),
-        ('letter', lambda x: x['eline-division-name'].split(" ")[1] if 'eline-division-name' in x else None),
+        ('name', lambda x: " ".join(_division_name(x['eline-division-name'])[0:2])
+            if 'eline-division-name' in x else None),
+        ('parallel', lambda x: int(_division_name(x['eline-division-name'])[0])
+            if 'eline-division-name' in x else None),
+        ('letter', lambda x: _division_name(x['eline-division-name'])[1] if 'eline-division-name' in x else None),
         ('id', 'id'),
     }
 
+    # Remote fields compared when deciding whether a user needs an update.
+    # middleName is left out on purpose: the server never stores it (see Known_mobedu_bugs.md),
+    # so it would always look changed
+    user_diff_fields = ('firstName', 'lastName', 'email', 'schoolId')
+    class_diff_fields = ('name', )
+
     default_group_mappings = {
-        ('name', lambda x: " ".join(x['eline-division-name'].split(" ")[0:2])),
+        ('name', lambda x: " ".join(_division_name(x['eline-division-name'])[0:2])),
         ('id', 'id'),
     }
 
-    def __init__(self, url):
-        self.url = str(url)
-        self.cookies = None
+    default_timeout = (10, 60)
+    default_page_concurrency = 8
+
+    def _init_metrics(self, metrics):
+        self.metrics = metrics if metrics is not None else RequestMetrics()
+        self._endpoint_for = EndpointClassifier(
+            (name, method, getattr(type(self), attr)) for name, method, attr in type(self).endpoints)
+
+    def _endpoint(self, method, url):
+        return self._endpoint_for(method, url[len(self.url):] if url.startswith(self.url) else url)
+
+    def _init_state(self):
+        # Guards the cached lists and their indexes when the controller is used from several threads
+        self._lock = threading.RLock()
         self.account = None
         self.managed_school = None
-        self.user_list = []
-        self.school_list = []
-        self.class_list = []
+        self._user_list = []
+        self._users_by_login = {}
+        self._users_by_id = {}
+        self._class_list = []
+        self._classes_by_key = {}
+        self._classes_by_id = {}
+        self._school_list = []
+        self._refreshed_at = None
+        self._auth_cookie = None
+        # Lists left to be fetched on first use, see _ensure_loaded
+        self._unloaded = set()
         self.teacher_roles = type(self).default_teacher_roles
         self.student_roles = type(self).default_student_roles
 
+    def _ensure_loaded(self, kind):
+        # Lists are fetched up front here; Controller.login leaves them for first use
+        pass
+
+    @property
+    def user_list(self):
+        self._ensure_loaded('users')
+        return self._user_list
+
+    @user_list.setter
+    def user_list(self, value):
+        with self._lock:
+            user_list = [self._user_entry(x) for x in value] if value is not None else []
+            by_login = {}
+            by_id = {}
+            for entry in user_list:
+                type(self)._index_user_in(by_login, by_id, entry)
+            # Assigned last, so that a list being fetched lazily is never seen half-indexed
+            self._user_list, self._users_by_login, self._users_by_id = user_list, by_login, by_id
+            self._unloaded.discard('users')
+
+    @property
+    def class_list(self):
+        self._ensure_loaded('classes')
+        return self._class_list
+
+    @class_list.setter
+    def class_list(self, value):
+        with self._lock:
+            class_list = list(value) if value is not None else []
+            by_key = {}
+            by_id = {}
+            for entry in class_list:
+                type(self)._index_class_in(by_key, by_id, entry)
+            self._class_list, self._classes_by_key, self._classes_by_id = class_list, by_key, by_id
+            self._unloaded.discard('classes')
+
+    @property
+    def school_list(self):
+        self._ensure_loaded('schools')
+        return self._school_list
+
+    @school_list.setter
+    def school_list(self, value):
+        with self._lock:
+            self._school_list = value if value is not None else []
+            self._unloaded.discard('schools')
+
+    def _user_entry(self, entry):
+        # What the cache keeps of a listed user
+        if self.compact_users and not isinstance(entry, UserRecord):
+            return UserRecord(entry, type(self).user_diff_fields)
+        return entry
+
+    @staticmethod
+    def _index_user_in(by_login, by_id, entry):
+        # First entry wins, the same way the old linear scans behaved
+        if 'login' in entry:
+            by_login.setdefault(entry['login'], entry)
+        if 'id' in entry:
+            by_id.setdefault(entry['id'], entry)
+
+    def _index_user(self, entry):
+        type(self)._index_user_in(self._users_by_login, self._users_by_id, entry)
+
+    def _unindex_user(self, entry):
+        if self._users_by_login.get(entry.get('login')) is entry:
+            del self._users_by_login[entry['login']]
+        if self._users_by_id.get(entry.get('id')) is entry:
+            del self._users_by_id[entry['id']]
+
+    def _cache_user(self, entry):
+        entry = self._user_entry(entry)
+        with self._lock:
+            old_entry = self._users_by_login.get(entry.get('login'))
+            if old_entry is not None:
+                self._uncache_user(old_entry)
+            self._user_list.append(entry)
+            self._index_user(entry)
+
+    def _uncache_user(self, entry):
+        with self._lock:
+            self._unindex_user(entry)
+            type(self)._remove_entry(self._user_list, entry)
+
+    def _update_cached_user(self, login, obj):
+        # Only fields the listing already has are updated, the cache doesn't
+        # grow into full user objects
+        cached_obj = self._users_by_login.get(login)
+        if isinstance(cached_obj, UserRecord):
+            cached_obj.update_from(obj)
+        elif cached_obj is not None:
+            for attr in obj:
+                if attr in cached_obj and attr not in ('login', 'id', 'password'):
+                    cached_obj[attr] = obj[attr]
+
+    @staticmethod
+    def _remove_entry(entries, entry):
+        for n, x in enumerate(entries):
+            if x is entry:
+                del entries[n]
+                return
+
+    @staticmethod
+    def _class_key(e_class):
+        return e_class.get('parallel'), e_class.get('letter')
+
+    @classmethod
+    def _index_class_in(cls, by_key, by_id, entry):
+        by_key.setdefault(cls._class_key(entry), []).append(entry)
+        if 'id' in entry:
+            by_id.setdefault(entry['id'], entry)
+
+    def _index_class(self, entry):
+        type(self)._index_class_in(self._classes_by_key, self._classes_by_id, entry)
+
+    def _unindex_class(self, entry):
+        key = type(self)._class_key(entry)
+        entries = [x for x in self._classes_by_key.get(key, []) if x is not entry]
+        if entries:
+            self._classes_by_key[key] = entries
+        else:
+            self._classes_by_key.pop(key, None)
+        if self._classes_by_id.get(entry.get('id')) is entry:
+            del self._classes_by_id[entry['id']]
+
+    def _cache_class(self, entry):
+        with self._lock:
+            old_entry = self._classes_by_id.get(entry.get('id'))
+            if old_entry is not None:
+                self._uncache_class(old_entry)
+            self._class_list.append(entry)
+            self._index_class(entry)
+
+    def _uncache_class(self, entry):
+        with self._lock:
+            self._unindex_class(entry)
+            type(self)._remove_entry(self._class_list, entry)
+
+    def class_for_object(self, obj):
+        """Find a cached class by parallel and letter (and schoolName, if given).
+
+            :param obj: mapped class object
+            :returns: cached class entry, or None if there is no such class
+
+        """
+        self._ensure_loaded('classes')
+        for entry in self._classes_by_key.get(type(self)._class_key(obj), []):
+            # Several schools can each have a 5 A
+            if ('schoolName' not in obj or obj['schoolName'] == entry['schoolName']) \
+                    and self.in_managed_school(entry):
+                return entry
+        if self._verify_on_miss('classes'):
+            return self.class_for_object(obj)
+        return None
+
+    def _resolve_class_id(self, obj):
+        if 'id' not in obj:
+            entry = self.class_for_object(obj)
+            if entry is not None:
+                obj['id'] = entry['id']
+        return obj
+
     def set_managed_school(self, school_id):
         if school_id in self.managed_school_list:
             self.managed_school = school_id
         else:
             raise ValueError()
 
-    def _get_json(self, current_url, alt=None):
-        response = requests.get(
-            current_url,
-            cookies=self.cookies,
+    def save_snapshot(self, path, include_cookie=False):
+        """Save account, users, classes and schools to a file for a warm start.
+
+            :param path: file name
+            :param include_cookie: also save the session cookie, so load_snapshot can skip authenticate
+
+        """
+        write_snapshot(path, {
+            'url': self.url,
+            'account': self.account,
+            'managed_school': self.managed_school,
+            'users': [x.to_dict() if isinstance(x, UserRecord) else x for x in self.user_list],
+            'classes': self.class_list,
+            'schools': self.school_list,
+            'cookie': self._auth_cookie if include_cookie else None,
+        })
+
+    def _load_snapshot_state(self, path, max_age=None):
+        # What load_snapshot does before checking anything against the server
+        state = read_snapshot(path, max_age=max_age)
+        if state is None or state.get('url') != self.url:
+            return False
+        self.account = state['account']
+        self.user_list = state['users']
+        self.class_list = state['classes']
+        self.school_list = state['schools']
+        self.managed_school = state['managed_school']
+        if state.get('cookie'):
+            self._set_auth_cookie(*state['cookie'])
+        self._refreshed_at = time.monotonic()
+        return True
+
+    def _verify_on_miss(self, kind):
+        # A lookup missed; True if the list was fetched again, so it's worth looking once more
+        return False
+
+    @staticmethod
+    def _cache_entry_from(response, obj):
+        # Prefer what the server says it has stored, fall back to what we sent
+        try:
+            entry = json_loads(response.content)
+        except json.decoder.JSONDecodeError:
+            entry = None
+        if not isinstance(entry, dict) or 'id' not in entry:
+            entry = dict(obj)
+        entry.pop('password', None)
+        return entry
+
+    @classmethod
+    def _map_object(cls, original_obj, mappings, old_obj=None):
+        # Compiled once per table; records that support it (LdapObject) keep
+        # their mapped form, so mapping one again is a dict copy
+        obj = compile_mapping(mappings)(original_obj)
+        if old_obj is not None:
+            for attr in old_obj:
+                if attr not in obj:
+                    obj[attr] = old_obj[attr]
+        return obj
+
+    @classmethod
+    def map_objects(cls, objects, mappings):
+        """Map many local objects at once.
+
+            :param objects: iterable of local objects
+            :param mappings: set of (remote, local) mappings, e.g. default_user_mappings
+            :returns: list of remote objects, fields in a fixed order
+
+        """
+        return compile_mapping(mappings).map_many(objects)
+
+    @classmethod
+    def mapping_attributes(cls, mappings):
+        """Local attribute names a mapping table reads.
+
+        Lambdas are run against a recording stand-in object to see what they touch.
+
+            :param mappings: set of (remote, local) mappings
+            :returns: set of local attribute names
+
+        """
+        attributes = set()
+        for remote, local in mappings:
+            if callable(local):
+                recorder = _AttributeRecorder()
+                try:
+                    local(recorder)
+                except Exception:
+                    pass
+                attributes |= recorder.seen
+            else:
+                attributes.add(local)
+        return attributes
+
+    @classmethod
+    def user_login(cls, user):
+        return cls._map_object(user, cls.default_user_mappings)['login']
+
+    @staticmethod
+    def _password_result(results, events, login, status, started, code=None, message=None):
+        results[login] = PasswordResult(status, code, message)
+        if events is not None:
+            event = {'time': time.time(), 'phase': 'passwords', 'key': login, 'action': 'set_password',
+                     'status': status}
+            if started is not None:
+                event['duration'] = time.monotonic() - started
+            if code is not None:
+                event['code'] = code
+            if message is not None:
+                event['message'] = message
+            events.emit(event)
+
+    @staticmethod
+    def _response_message(response, limit=200):
+        # The start of an error response's body, e.g. the server's error key
+        if response is None or not response.content:
+            return None
+        return response.content.decode('utf-8', 'replace').strip()[:limit] or None
+
+    def _password_logins(self, passwords, results, events):
+        # Logins set_passwords has users for; the others are reported missing right away
+        found = []
+        for login in passwords:
+            if self.has_login(login):
+                found.append(login)
+            else:
+                type(self)._password_result(results, events, login, 'missing', None, message="User not found")
+        if events is not None:
+            events.emit({'time': time.time(), 'phase': 'plan', 'key': None, 'action': None, 'status': 'planned',
+                         'operations': len(found), 'unchanged': 0, 'journaled': 0})
+        return found
+
+    def in_managed_school(self, remote_obj):
+        """Whether a cached user or class belongs to managed_school, as far as the listing tells."""
+        if 'schoolId' in remote_obj:
+            return remote_obj['schoolId'] == self.managed_school
+        if isinstance(remote_obj.get('school'), dict) and 'id' in remote_obj['school']:
+            return remote_obj['school']['id'] == self.managed_school
+        return True
+
+    def get_cached_member_id(self, user):
+        obj = type(self)._map_object(user, type(self).default_user_mappings)
+        try:
+            return self.user_for_login(obj['login']).get('id')
+        except UserDoesNotExist:
+            return None
+
+    def class_key_for(self, e_class):
+        return type(self)._class_key(type(self)._map_object(e_class, type(self).default_class_mappings))
+
+    @property
+    def login_list(self):
+        self._ensure_loaded('users')
+        return list(self._users_by_login)
+
+    def cached_user_id(self, login):
+        # Unlike user_for_login, never goes to the server, unless the list isn't loaded yet
+        self._ensure_loaded('users')
+        entry = self._users_by_login.get(login)
+        return entry.get('id') if entry is not None else None
+
+    def has_login(self, login):
+        self._ensure_loaded('users')
+        if login in self._users_by_login:
+            return True
+        if self._verify_on_miss('users'):
+            return login in self._users_by_login
+        return False
+
+    def user_for_id(self, user_id):
+        self._ensure_loaded('users')
+        if user_id not in self._users_by_id:
+            raise UserDoesNotExist()
+        return self._users_by_id[user_id]
+
+    @property
+    def managed_school_list(self):
+        if self.account is not None and \
+                        'additionalUserInfoDTO' in self.account and \
+                        'adminSchools' in self.account['additionalUserInfoDTO']:
+            return [x['id'] for x in self.account['additionalUserInfoDTO']['adminSchools']]
+        else:
+            return []
+
+    @property
+    def managed_school_detail(self):
+        for school in self.school_list:
+            if school['id'] == self.managed_school:
+                return school
+        return {}
+
+    def user_for_login(self, login):
+        if not self.has_login(login):
+            raise UserDoesNotExist()
+        return self._users_by_login[login]
+
+
+class Controller(BaseController):
+    default_pool_size = 10
+    default_max_retries = 3
+    default_detail_cache_ttl = 60
+    default_detail_cache_size = 4096
+
+    def __init__(self, url, session=None, pool_size=None, timeout=None, max_retries=None, keep_alive=True,
+                 page_concurrency=None, consistency_check_interval=None,
+                 detail_cache_ttl=None, detail_cache_size=None, rate_limiter=None, metrics=None,
+                 compact_users=False):
+        """Create a controller for a mob-edu instance.
+
+            :param url: base url of the instance
+            :param session: requests.Session to use, a pooled one is created if omitted
+            :param pool_size: max keep-alive connections kept per host
+            :param timeout: requests timeout, either a number or a (connect, read) tuple
+            :param max_retries: retries on connection errors (not on HTTP errors)
+            :param keep_alive: set to False to close connections after each request
+            :param page_concurrency: how many list pages are fetched at once
+            :param consistency_check_interval: if set, seconds after which a write makes check_consistency
+                                               due; it's run by run_due_check
+            :param detail_cache_ttl: seconds user/class/group details are cached for, 0 disables the cache
+            :param detail_cache_size: max number of cached details
+            :param rate_limiter: AdaptiveLimiter shared by all requests; size the pool for its max_concurrency
+            :param metrics: RequestMetrics to count requests in, e.g. one shared by several controllers
+            :param compact_users: keep listed users as UserRecords instead of full dicts, to save memory
+
+        """
+        self.url = str(url)
+        self.timeout = timeout if timeout is not None else type(self).default_timeout
+        if session is None:
+            session = type(self)._make_session(
+                pool_size if pool_size is not None else type(self).default_pool_size,
+                max_retries if max_retries is not None else type(self).default_max_retries,
+                keep_alive,
+            )
+        self.session = session
+        self.page_concurrency = page_concurrency if page_concurrency is not None \
+            else type(self).default_page_concurrency
+        self.consistency_check_interval = consistency_check_interval
+        if detail_cache_ttl is None:
+            detail_cache_ttl = type(self).default_detail_cache_ttl
+        if detail_cache_ttl:
+            self.detail_cache = DetailCache(
+                ttl=detail_cache_ttl,
+                max_size=detail_cache_size if detail_cache_size is not None else type(self).default_detail_cache_size,
+            )
+        else:
+            self.detail_cache = None
+        self.rate_limiter = rate_limiter
+        self.compact_users = compact_users
+        self._init_metrics(metrics)
+        self._init_state()
+
+    def _init_state(self):
+        super(Controller, self)._init_state()
+        self._check_due = False
+        # For logging in again when the session expires, see login
+        self._credentials = None
+        self._cookie_path = None
+        self._auth_generation = 0
+        self._auth_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # Lists loaded from a snapshot and not checked against the server yet
+        self._unverified = set()
+
+    @staticmethod
+    def _make_session(pool_size, max_retries, keep_alive):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=max_retries,
         )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def cookies(self):
+        return self.session.cookies
+
+    # Loader of each list login() leaves to be fetched on first use
+    _list_loaders = {
+        'users': '_get_user_list',
+        'classes': '_get_class_list',
+        'schools': '_get_school_list',
+    }
+
+    def _ensure_loaded(self, kind):
+        # Fetch a list login() left unloaded, once. Not under _lock: other threads
+        # only wait for it if they need the same list
+        if kind not in self._unloaded:
+            return
+        with self._load_lock:
+            if kind in self._unloaded:
+                getattr(self, type(self)._list_loaders[kind])()
+                with self._lock:
+                    if self._refreshed_at is None:
+                        self._refreshed_at = time.monotonic()
+
+    def _set_auth_cookie(self, cookie_name, cookie_value):
+        self._auth_cookie = (cookie_name, cookie_value)
+        self.session.cookies.set(cookie_name, cookie_value)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _request(self, method, url, **kwargs):
+        endpoint = self._endpoint(method, url)
+        status_code = None
+        sent = received = 0
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status_code = response.status_code
+            sent = len(response.request.body or b'')
+            received = len(response.content)
+            return response
+        finally:
+            self.metrics.observe(endpoint, method, url, status_code, time.monotonic() - started, sent, received)
+
+    def _send(self, method, url, **kwargs):
+        if 'json' in kwargs:
+            # Encoded with our codec rather than by requests
+            kwargs['data'] = json_dumps(kwargs.pop('json'))
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'Content-Type': 'application/json'})
+        generation = self._auth_generation
+        response = self._send_once(method, url, **kwargs)
+        if response is not None and response.status_code == 401 and self._reauthenticate(generation):
+            # The session expired; tried once more with a new one
+            response = self._send_once(method, url, **kwargs)
+        return response
+
+    def _send_once(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.rate_limiter is None:
+            return self._request(method, url, **kwargs)
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            status_code = None
+            retry_after = None
+            started = time.monotonic()
+            try:
+                response = self._request(method, url, **kwargs)
+                status_code = response.status_code
+                retry_after = type(self)._retry_after(response)
+            except requests.exceptions.RequestException:
+                if not self.rate_limiter.should_retry(method, None, attempt):
+                    raise
+                response = None
+            finally:
+                self.rate_limiter.release(status_code, time.monotonic() - started, retry_after)
+            if not self.rate_limiter.should_retry(method, status_code, attempt):
+                return response
+            attempt += 1
+
+    @staticmethod
+    def _retry_after(response):
         try:
-            return json.loads(response.text)
+            return float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+
+    def for_school(self, school_id):
+        """Controller for another of our schools, sharing this one's session and caches.
+
+        Only managed_school is its own; everything else (session, cookie, cached
+        lists and their indexes, detail cache, metrics) is this controller's,
+        so a write through either shows up in both. Several of them can be
+        used from different threads at once.
+
+            :param school_id: one of managed_school_list
+            :returns: Controller of the same class
+
+        """
+        if school_id not in self.managed_school_list:
+            raise ValueError("School {} is not managed by this account".format(school_id))
+        view = object.__new__(_school_view_class(type(self)))
+        object.__setattr__(view, '_shared', getattr(self, '_shared', self))
+        view.managed_school = school_id
+        return view
+
+    def _get_json(self, current_url, alt=None):
+        response = self._send('GET', current_url)
+        try:
+            return json_loads(response.content)
         except json.decoder.JSONDecodeError:
             return alt
 
-    def _get_user_list(self):
+    def _get_page(self, current_url, convert=None):
+        # One page of a listing; objects are converted as soon as they're decoded
+        response = self._send('GET', current_url)
+        try:
+            if convert is None:
+                return list(iter_json_array(response.content))
+            return [convert(x) for x in iter_json_array(response.content)]
+        except json.decoder.JSONDecodeError:
+            return []
+
+    def _get_paged_list(self, url, expected=0, convert=None):
+        # The server won't give us more than 100 objects per page, so we have to walk
+        # the pages until an empty one. To save round trips, pages are requested in
+        # windows of page_concurrency at once (the first window is stretched to cover
+        # the expected number of objects); everything after the first empty page
+        # of a window is thrown away. Objects are passed through convert, if given,
+        # as they're decoded.
+        result = []
         n = 1
-        self.user_list = []
-        while True:
-            current = self._get_json(self.url + type(self).users_url.format(n=n), [])
-            self.user_list += current
-            if len(current) == 0:
-                break
-            else:
-                n+=1
+        window = max(1, self.page_concurrency)
+        size = max(window, expected // type(self).page_size + 2)
+        with ThreadPoolExecutor(max_workers=window) as pool:
+            while True:
+                pages = pool.map(lambda x: self._get_page(self.url + url.format(n=x), convert),
+                                 range(n, n + size))
+                for current in pages:
+                    if len(current) == 0:
+                        return result
+                    result += current
+                n += size
+                size = window
+
+    def _get_user_list(self):
+        self.user_list = self._get_paged_list(type(self).users_url, len(self._user_list), self._user_entry)
+        self._unverified.discard('users')
 
     def _get_class_list(self):
-        n = 1
-        self.class_list = []
-        while True:
-            current = self._get_json(self.url + type(self).classes_url.format(n=n), [])
-            self.class_list += current
-            if len(current) == 0:
-                break
-            else:
-                n+=1
+        self.class_list = self._get_paged_list(type(self).classes_url, len(self._class_list))
+        self._unverified.discard('classes')
+
 
     def _get_school_list(self):
         self.school_list = self._get_json(self.url + type(self).school_url, [])
 
+    def refresh(self):
+        """Refetch users, classes and schools from the server.
+
+        Writes keep the cache up to date by themselves, so this is only needed
+        if something else changes the server behind our back.
+        """
+        with self.metrics.phase('refresh'):
+            self._get_user_list()
+            self._get_class_list()
+            self._get_school_list()
+        self._refreshed_at = time.monotonic()
+
+    def check_consistency(self):
+        """Refresh the cache and report how far it had drifted from the server.
+
+            :returns: dict of lists: new_users, gone_users (logins), new_classes, gone_classes (ids)
+
+        """
+        self._ensure_loaded('users')
+        self._ensure_loaded('classes')
+        logins = set(self._users_by_login)
+        class_ids = set(self._classes_by_id)
+        self.refresh()
+        return {
+            'new_users': sorted(set(self._users_by_login) - logins),
+            'gone_users': sorted(logins - set(self._users_by_login)),
+            'new_classes': sorted(set(self._classes_by_id) - class_ids),
+            'gone_classes': sorted(class_ids - set(self._classes_by_id)),
+        }
+
+    def load_snapshot(self, path, max_age=None, validate=False):
+        """Load state saved by save_snapshot instead of fetching it.
+
+        Unless validate is set, the lists are trusted until a lookup misses,
+        then the missing list is refetched once.
+
+            :param path: file name
+            :param max_age: seconds; older snapshots are ignored
+            :param validate: check the snapshot against the server right away with validate_snapshot
+            :returns: True if the snapshot was loaded, False if there was no usable one
+
+        """
+        if not self._load_snapshot_state(path, max_age=max_age):
+            return False
+        self._unverified = {'users', 'classes'}
+        if validate:
+            self.validate_snapshot()
+        return True
+
+    def validate_snapshot(self):
+        """Cheaply check the cached lists against the server.
+
+        Only the first page, the last page and the page after it are fetched for
+        users and classes; a list that doesn't match them is refetched in full.
+        Changes in the middle of a list go unnoticed until a lookup misses.
+
+            :returns: True if the cache matched
+
+        """
+        matched = True
+        for url, kind, refetch in ((type(self).users_url, 'users', self._get_user_list),
+                                   (type(self).classes_url, 'classes', self._get_class_list)):
+            cached = self.user_list if kind == 'users' else self.class_list
+            by_id = self._users_by_id if kind == 'users' else self._classes_by_id
+            size = type(self).page_size
+            last = max(1, (len(cached) + size - 1) // size)
+            pages = sorted({1, last, last + 1})
+            with ThreadPoolExecutor(max_workers=len(pages)) as pool:
+                remote = list(pool.map(lambda x: self._get_json(self.url + url.format(n=x), []), pages))
+            # Entries are compared by id: writes made from several threads are
+            # cached in the order they finished, not in the listing's order
+            if any(len(page) != len(cached[(n - 1) * size:n * size]) or
+                   any(by_id.get(x.get('id')) != x for x in page)
+                   for n, page in zip(pages, remote)):
+                matched = False
+                refetch()
+            self._unverified.discard(kind)
+        return matched
+
+    def _verify_on_miss(self, kind):
+        # A lookup missed; if the list came from a snapshot, refetch it once
+        if kind not in self._unverified:
+            return False
+        self._unverified.discard(kind)
+        if kind == 'users':
+            self._get_user_list()
+        else:
+            self._get_class_list()
+        return True
+
+    def _after_write(self):
+        # Only note that a check is due: refreshing here would refetch the lists once
+        # per concurrent writer, and drop whatever the others cache in the meantime
+        if self.consistency_check_interval is None:
+            return
+        with self._lock:
+            if self._refreshed_at is None or \
+                    time.monotonic() - self._refreshed_at > self.consistency_check_interval:
+                self._check_due = True
+
+    def run_due_check(self):
+        """Run check_consistency if a write has made one due, see consistency_check_interval.
+
+        Import plans call this between phases, when none of their writes is in
+        flight; a script writing on its own calls it whenever it suits it.
+
+            :returns: what check_consistency returned, None if no check was due
+
+        """
+        with self._lock:
+            if not self._check_due:
+                return None
+            # Claimed: other threads asking now find nothing due
+            self._check_due = False
+            self._refreshed_at = time.monotonic()
+        return self.check_consistency()
+
+    def _fetch_detail(self, current_url, stale_entry):
+        headers = {}
+        if stale_entry is not None:
+            if stale_entry.etag is not None:
+                headers['If-None-Match'] = stale_entry.etag
+            if stale_entry.last_modified is not None:
+                headers['If-Modified-Since'] = stale_entry.last_modified
+        response = self._send('GET', current_url, headers=headers)
+        if response.status_code == 304 and stale_entry is not None:
+            return stale_entry.value, response.headers.get('ETag') or stale_entry.etag, \
+                response.headers.get('Last-Modified') or stale_entry.last_modified, True
+        try:
+            value = json_loads(response.content)
+        except json.decoder.JSONDecodeError:
+            value = None
+        # Only a 200 is the object itself; an error body is passed on, but not kept
+        return value, response.headers.get('ETag'), response.headers.get('Last-Modified'), \
+            response.status_code == 200
+
+    def _get_detail_json(self, current_url):
+        if self.detail_cache is None:
+            return self._get_json(current_url)
+        return self.detail_cache.get(current_url, self._fetch_detail)
+
+    def _invalidate_detail(self, current_url):
+        if self.detail_cache is not None:
+            self.detail_cache.invalidate(current_url)
+
     def _get_user_detail(self, user):
-        return self._get_json(self.url + type(self).user_detail_url.format(user=user))
+        return self._get_detail_json(self.url + type(self).user_detail_url.format(user=user))
 
     def _get_class_detail(self, e_class):
-        return self._get_json(self.url + type(self).class_detail_url.format(e_class=e_class))
+        return self._get_detail_json(self.url + type(self).class_detail_url.format(e_class=e_class))
+
+    def _get_group_detail(self, group):
+        return self._get_detail_json(self.url + type(self).group_detail_url.format(group=group))
 
     def _request_json_object(self, url, obj, method):
+        if method != 'POST':
+            # PUTs go to the collection url with the id in the body, DELETEs to the detail url;
+            # either way the cached detail is gone, even if the request fails halfway
+            self._invalidate_detail(url)
+            if obj is not None and 'id' in obj:
+                self._invalidate_detail("{}/{}".format(url, obj['id']))
         if obj is not None:
-            response = method(
-                url,
-                cookies=self.cookies,
-                json=obj
-            )
+            response = self._send(method, url, json=obj)
         else:
-            response = method(
-                url,
-                cookies=self.cookies,
-            )
+            response = self._send(method, url)
 
         if response.status_code == 200:
             return response
@@ -149,31 +990,17 @@ class Controller(object):
             raise RequestFailedException(code=response.status_code, response=response)
 
     def _post_json_object(self, url, obj):
-        return self._request_json_object(url, obj, requests.post)
+        return self._request_json_object(url, obj, 'POST')
 
     def _put_json_object(self, url, obj):
-        return self._request_json_object(url, obj, requests.put)
+        return self._request_json_object(url, obj, 'PUT')
 
     def _delete_object(self, url):
-        return self._request_json_object(url, None, requests.delete)
-
-    @classmethod
-    def _map_object(cls, original_obj, mappings, old_obj=None):
-        obj = {}
-        for remote, local in mappings:
-            if callable(local):
-                obj[remote] = local(original_obj)
-            elif local in original_obj:
-                obj[remote] = original_obj[local]
-        if old_obj is not None:
-            for attr in old_obj:
-                if attr not in obj:
-                    obj[attr] = old_obj[attr]
-        return obj
+        return self._request_json_object(url, None, 'DELETE')
 
     def create_user(self, user, teacher=False, skip_update=False):
         obj = type(self)._map_object(user, type(self).default_user_mappings)
-        if obj['login'] in self.login_list:
+        if self.has_login(obj['login']):
             raise UserExists()
         obj['schoolId'] = self.managed_school
         if 'roles' not in obj:
@@ -186,9 +1013,11 @@ class Controller(object):
             if 'active' in obj and not obj['active']:
                 # Cowardly refusing to create an inactive user
                 return True
-            self._post_json_object(current_url, obj)
-            if not skip_update:
-                self._get_user_list()
+            response = self._post_json_object(current_url, obj)
+            # The listing is updated in place; skip_update is kept for compatibility,
+            # there's no full refetch to skip any more
+            self._cache_user(type(self)._cache_entry_from(response, obj))
+            self._after_write()
             return True
         except RequestFailedException as e:
             if e.code == 409:
@@ -198,7 +1027,7 @@ class Controller(object):
 
     def update_user(self, user):
         obj = type(self)._map_object(user, type(self).default_user_mappings)
-        if obj['login'] not in self.login_list:
+        if not self.has_login(obj['login']):
             raise UserDoesNotExist()
         cached_obj = self.user_for_login(obj['login'])
         old_obj = self._get_user_detail(user=cached_obj)
@@ -211,18 +1040,93 @@ class Controller(object):
             self._put_json_object(current_url, obj)
         except RequestFailedException as e:
             return False
+        self._update_cached_user(obj['login'], obj)
 
         try:
             if 'active' in obj:
                 self._put_json_object(self.url +  type(self).activate_user_url,
                                       {'id': obj['id'], 'activate': obj['active']})
+                self._invalidate_detail(self.url + type(self).user_detail_url.format(user=obj))
+            self._after_write()
             return True
         except RequestFailedException:
             raise OperationalError
 
+    def activate_user(self, user):
+        obj = type(self)._map_object(user, type(self).default_user_mappings)
+        if not self.has_login(obj['login']):
+            raise UserDoesNotExist()
+        cached_obj = self.user_for_login(obj['login'])
+        try:
+            self._put_json_object(self.url + type(self).activate_user_url,
+                                  {'id': cached_obj['id'], 'activate': obj['active']})
+            self._invalidate_detail(self.url + type(self).user_detail_url.format(user=cached_obj))
+            self._update_cached_user(obj['login'], {'active': obj['active'], 'activated': obj['active']})
+            self._after_write()
+            return True
+        except RequestFailedException:
+            return False
+
+    def diff_user(self, user):
+        """Find out what has to be done to bring a remote user in line with a local one.
+
+            :param user: local user object
+            :returns: (action, changed fields); action is 'create', 'update', 'activate' or None
+
+        """
+        obj = type(self)._map_object(user, type(self).default_user_mappings)
+        if not self.has_login(obj['login']):
+            if 'active' in obj and not obj['active']:
+                # create_user won't create it anyway
+                return None, []
+            return 'create', sorted(x for x in obj if x != 'password')
+        obj['schoolId'] = self.managed_school
+        remote_obj = self.user_for_login(obj['login'])
+        if isinstance(remote_obj, UserRecord):
+            changed = remote_obj.changed_fields(obj, type(self).user_diff_fields)
+        else:
+            if not any(x in remote_obj for x in type(self).user_diff_fields):
+                # The listing doesn't tell us enough, ask for the whole thing
+                remote_obj = self._get_user_detail(user=remote_obj)
+            changed = [x for x in type(self).user_diff_fields
+                       if x in obj and x in remote_obj and obj[x] != remote_obj[x]]
+        if changed:
+            return 'update', changed
+        remote_active = remote_obj.get('active', remote_obj.get('activated'))
+        if 'active' in obj and remote_active is not None and bool(remote_active) != obj['active']:
+            return 'activate', ['active']
+        return None, []
+
+    def diff_class(self, e_class):
+        """Same as diff_user, for classes.
+
+            :param e_class: local class object
+            :returns: (action, changed fields); action is 'create', 'update' or None
+
+        """
+        obj = type(self)._map_object(e_class, type(self).default_class_mappings)
+        remote_obj = self.class_for_object(obj)
+        if remote_obj is None:
+            return 'create', sorted(obj)
+        changed = [x for x in type(self).class_diff_fields
+                   if x in obj and x in remote_obj and obj[x] != remote_obj[x]]
+        if changed:
+            return 'update', changed
+        return None, []
+
     def set_password(self, login, password):
+        try:
+            self._set_password(login, password)
+        except (RequestFailedException, OperationalError):
+            return False
+        return True
+
+    def _set_password(self, login, password):
+        # Like set_password, but a refusal is raised with the server's response
         cached_obj = self.user_for_login(login)
         old_obj = self._get_user_detail(user=cached_obj)
+        if not isinstance(old_obj, dict):
+            raise OperationalError("Can't read the user's detail")
         obj = {
             'password': password,
         }
@@ -231,26 +1135,84 @@ class Controller(object):
                 obj[attr] = old_obj[attr]
         obj['schoolId'] = self.managed_school
         current_url = self.url + type(self).user_url
-        try:
-            self._put_json_object(current_url, obj)
-        except RequestFailedException as e:
-            return False
+        self._put_json_object(current_url, obj)
+
+    def set_passwords(self, passwords, executor=None, events=None):
+        """Set the passwords of many users, several at a time.
+
+        Logins are looked up in the cached user list; every user's detail is
+        fetched and PUT back with its new password on executor. One user
+        failing doesn't stop the others.
+
+            :param passwords: (login, password) pairs, e.g. from Passwords.read_password_csv;
+                              for a login given twice, the last password counts
+            :param executor: ImportExecutor, ImportExecutor() if omitted
+            :param events: EventStream told about every login (phase 'passwords',
+                           status 'updated', 'missing' or 'failed', with code and message
+                           when the server refused)
+            :returns: OrderedDict {login: PasswordResult}, in input order; its status is
+                      'updated', 'missing' or 'failed', code and message tell why it failed
 
+        """
+        passwords = OrderedDict(passwords)
+        results = OrderedDict((login, None) for login in passwords)
+        executor = executor if executor is not None else ImportExecutor()
+
+        def reset(login):
+            started = time.monotonic()
+            try:
+                self._set_password(login, passwords[login])
+            except UserDoesNotExist:
+                type(self)._password_result(results, events, login, 'missing', started)
+            except RequestFailedException as e:
+                type(self)._password_result(results, events, login, 'failed', started, code=e.code,
+                                            message=type(self)._response_message(e.response))
+            except (OperationalError, requests.RequestException) as e:
+                type(self)._password_result(results, events, login, 'failed', started, message=str(e))
+            else:
+                type(self)._password_result(results, events, login, 'updated', started)
+
+        try:
+            executor.map(reset, self._password_logins(passwords, results, events))
+        finally:
+            if events is not None:
+                events.flush()
+        return results
 
     def delete_user(self, user):
         obj = type(self)._map_object(user, type(self).default_user_mappings)
-        if obj['login'] not in self.login_list:
+        if not self.has_login(obj['login']):
             raise UserDoesNotExist()
-        cached_obj = self.user_for_login(obj['login'])
-        current_url = self.url + type(self).user_detail_url.format(user=cached_obj)
+        return self.delete_remote_user(self.user_for_login(obj['login']))
+
+    def delete_remote_user(self, remote_user):
+        """Delete a user by its cached (remote) entry, as found in user_list."""
+        current_url = self.url + type(self).user_detail_url.format(user=remote_user)
         try:
             self._delete_object(current_url)
-            self._get_user_list()
-            return True
         except RequestFailedException as e:
             return False
+        cached_obj = self._users_by_id.get(remote_user['id'])
+        if cached_obj is not None:
+            self._uncache_user(cached_obj)
+        self._after_write()
+        return True
 
-    def create_class(self, e_class):
+    def deactivate_remote_user(self, remote_user):
+        """Disable a user by its cached (remote) entry, keeping the account and its history."""
+        try:
+            self._put_json_object(self.url + type(self).activate_user_url,
+                                  {'id': remote_user['id'], 'activate': False})
+        except RequestFailedException:
+            return False
+        self._invalidate_detail(self.url + type(self).user_detail_url.format(user=remote_user))
+        cached_obj = self._users_by_id.get(remote_user['id'])
+        if cached_obj is not None:
+            self._update_cached_user(cached_obj['login'], {'active': False, 'activated': False})
+        self._after_write()
+        return True
+
+    def create_class(self, e_class, on_created=None):
         # Now this probably requires at least some explanation
         #
         # We have two entities in mobedu - classes, and groups
@@ -276,36 +1238,66 @@ class Controller(object):
             return False
 
         try:
-            obj = json.loads(response.text)
+            obj = json_loads(response.content)
         except json.decoder.JSONDecodeError:
             return False
 
+        # The class exists now whatever happens to the group
+        self._cache_class(obj)
+        if on_created is not None:
+            on_created(obj)
+
         # Class created and stored as obj, now try to create a user_group
+        self.create_class_group(e_class, obj)
+
+        # Insanity and courage! It worked.
+        self._after_write()
+        return True
+
+    def create_class_group(self, e_class, class_obj):
+        """Create the group of a class. Only needed on its own to repair a class whose group wasn't created.
+
+            :param e_class: local class object
+            :param class_obj: remote class object, only 'id' is used
+
+        """
         group_obj = type(self)._map_object(e_class, type(self).default_group_mappings)
-        group_obj["learningClassId"] = obj['id']
+        group_obj["learningClassId"] = class_obj['id']
 
         current_url = self.url + type(self).group_url
         try:
             self._post_json_object(current_url, group_obj)
         except RequestFailedException as e:
             raise OperationalError
-
-        # Insanity and courage! It worked.
-        self._get_class_list()
+        finally:
+            # The class now points to its group
+            self._invalidate_detail(self.url + type(self).class_detail_url.format(e_class=class_obj))
+
+        cached_obj = self._classes_by_id.get(class_obj['id'])
+        if cached_obj is not None:
+            # Cached from before the group existed; the listing has the group now, and the
+            # cache has to match it (see validate_snapshot). Setting members reads this detail anyway
+            detail = self._get_class_detail(e_class=class_obj)
+            if isinstance(detail, dict) and 'userGroup' in detail:
+                with self._lock:
+                    cached_obj['userGroup'] = detail['userGroup']
+
+    def repair_class(self, e_class):
+        """Create the missing group of an existing class."""
+        obj = type(self)._map_object(e_class, type(self).default_class_mappings)
+        self._resolve_class_id(obj)
+        self.create_class_group(e_class, obj)
         return True
 
     def update_class(self, e_class, mappings=None):
         obj = type(self)._map_object(e_class, type(self).default_class_mappings)
-
-        if 'id' not in obj:
-            for entry in self.class_list:
-                if entry['parallel'] == obj['parallel'] and \
-                    entry['letter'] == obj['letter'] and \
-                        ('schoolName' not in obj or obj['schoolName'] == entry['schoolName']):
-                    obj['id'] = entry['id']
-                    break
+        self._resolve_class_id(obj)
 
         old_obj = self._get_class_detail(e_class=obj)
+        if not old_obj.get('userGroup'):
+            # Left behind by a create_class that failed halfway
+            self.create_class_group(e_class, old_obj)
+            old_obj = self._get_class_detail(e_class=obj)
         for attr in old_obj:
             if attr not in obj:
                 obj[attr] = old_obj[attr]
@@ -321,50 +1313,60 @@ class Controller(object):
 
         group_obj = type(self)._map_object(e_class, type(self).default_group_mappings)
         group_obj["learningClassId"] = obj['id']
-        group_obj['id'] = \
-            self._get_json(self.url + type(self).group_detail_url.format(group=old_obj['userGroup']))['id']
+        group_obj['id'] = self._get_group_detail(old_obj['userGroup'])['id']
         try:
             self._put_json_object(current_url, group_obj)
         except RequestFailedException as e:
             raise OperationalError
 
-        self._get_class_list()
+        cached_obj = self._classes_by_id.get(obj['id'])
+        if cached_obj is not None:
+            for attr in obj:
+                if attr in cached_obj and attr != 'id':
+                    cached_obj[attr] = obj[attr]
+        self._after_write()
         return True
 
     def delete_class(self, e_class):
         obj = type(self)._map_object(e_class, type(self).default_class_mappings)
-        old_obj = self._get_class_detail(e_class=obj)
+        self._resolve_class_id(obj)
+        return self.delete_remote_class(obj)
+
+    def delete_remote_class(self, class_obj):
+        """Delete a class and its group, by a remote class object; only 'id' is used."""
+        old_obj = self._get_class_detail(e_class=class_obj)
         current_url = self.url + type(self).class_detail_url.format(e_class=old_obj)
         try:
             self._delete_object(current_url)
         except RequestFailedException as e:
             return False
 
-        group_obj = self._get_json(self.url + type(self).group_detail_url.format(group=old_obj['userGroup']))
+        cached_obj = self._classes_by_id.get(old_obj['id'])
+        if cached_obj is not None:
+            self._uncache_class(cached_obj)
 
-        current_url = self.url + type(self).group_detail_url.format(group=group_obj)
+        if old_obj.get('userGroup'):
+            group_obj = self._get_group_detail(old_obj['userGroup'])
 
-        try:
-            self._delete_object(current_url)
-        except RequestFailedException as e:
-            raise OperationalError
+            current_url = self.url + type(self).group_detail_url.format(group=group_obj)
+
+            try:
+                self._delete_object(current_url)
+            except RequestFailedException as e:
+                raise OperationalError
 
-        self._get_class_list()
+        self._after_write()
         return True
 
     def get_class_group(self, e_class):
         obj = type(self)._map_object(e_class, type(self).default_class_mappings)
-
-        if 'id' not in obj:
-            for entry in self.class_list:
-                if entry['parallel'] == obj['parallel'] and \
-                    entry['letter'] == obj['letter'] and \
-                        ('schoolName' not in obj or obj['schoolName'] == entry['schoolName']):
-                    obj['id'] = entry['id']
-                    break
+        self._resolve_class_id(obj)
 
         old_obj = self._get_class_detail(e_class=obj)
-        group_obj = self._get_json(self.url + type(self).group_detail_url.format(group=old_obj['userGroup']))
+        if not old_obj.get('userGroup'):
+            # A class without a group, see create_class_group
+            return None
+        group_obj = self._get_group_detail(old_obj['userGroup'])
 
         if 'userIds' not in group_obj and 'users' in group_obj:
             group_obj['userIds'] = [x['id'] for x in group_obj['users']]
@@ -373,19 +1375,12 @@ class Controller(object):
 
     def _get_user_object(self, user):
         obj = type(self)._map_object(user, type(self).default_user_mappings)
-        if obj['login'] not in self.login_list:
+        if not self.has_login(obj['login']):
             raise UserDoesNotExist()
         cached_obj = self.user_for_login(obj['login'])
         old_obj = self._get_user_detail(user=cached_obj)
         return old_obj
 
-    def get_cached_member_id(self, user):
-        obj = type(self)._map_object(user, type(self).default_user_mappings)
-        for entry in self.user_list:
-            if obj['login'] == entry['login']:
-                return entry['id']
-        return None
-
     def _set_group_members(self, group_obj):
         current_url = self.url + type(self).groups_url
 
@@ -399,47 +1394,114 @@ class Controller(object):
         except RequestFailedException as e:
             raise OperationalError
 
-    def set_class_members(self, e_class, user_ids):
+    def update_class_group(self, e_class, change):
+        """Change the members of a class group, skipping the PUT if nothing changes.
+
+            :param e_class: local class object
+            :param change: callable(current user ids) -> new user ids
+            :returns: True if the group was updated, False if it was already right
+
+        """
         group_obj = self.get_class_group(e_class)
+        if group_obj is None:
+            raise OperationalError
+        user_ids = list(change(group_obj['userIds']))
+        if len(user_ids) == len(group_obj['userIds']) and set(user_ids) == set(group_obj['userIds']):
+            return False
         group_obj['userIds'] = user_ids
 
         self._set_group_members(group_obj)
+        return True
 
-    def add_class_member(self, e_class, user):
-        group_obj = self.get_class_group(e_class)
-        user_obj = self._get_user_object(user)
+    def membership_batch(self):
+        """Start a MembershipBatch: queue membership changes, send them with flush()."""
+        from .Membership import MembershipBatch
+        return MembershipBatch(self)
 
-        if user not in group_obj['userIds']:
-            group_obj['userIds'].append(user_obj['id'])
+    def _member_id(self, user):
+        id = self.get_cached_member_id(user)
+        if id is None:
+            id = self._get_user_object(user)['id']
+        return id
 
-        self._set_group_members(group_obj)
+    def set_class_members(self, e_class, user_ids):
+        return self.update_class_group(e_class, lambda current: user_ids)
+
+    def add_class_member(self, e_class, user):
+        user_id = self._member_id(user)
+        return self.update_class_group(e_class, lambda current: current + [user_id]
+                                       if user_id not in current else current)
 
     def remove_class_member(self, e_class, user):
-        group_obj = self.get_class_group(e_class)
-        user_obj = self._get_user_object(user)
+        user_id = self._member_id(user)
+        return self.update_class_group(e_class, lambda current: [x for x in current if x != user_id])
 
-        if user_obj['id'] in group_obj['userIds']:
-            group_obj['userIds'] = [x for x in group_obj['userIds'] if x != user_obj['id']]
+    def authenticate(self, username, password, cookie_path=None, cookie_max_age=None):
+        """Authenticate user, set account attribute, and fetch users, classes and schools.
 
-        self._set_group_members(group_obj)
+            :param username: username for authorisation
+            :param password: password for authorisation
+            :param cookie_path: see login
+            :param cookie_max_age: see login
+            :returns: True if authorisation was successful, False otherwise
+
+        """
+        if not self.login(username, password, cookie_path=cookie_path, cookie_max_age=cookie_max_age):
+            return False
+        self.refresh()
+        return True
 
-    def authenticate(self, username, password):
-        """Authenticate user, set account attribute.
+    def login(self, username, password, cookie_path=None, cookie_max_age=None):
+        """Authenticate user and set account attribute, without fetching anything else.
+
+        Users, classes and schools are fetched when first needed. With
+        cookie_path, the session cookie is kept in that file (readable by the
+        owner only) and reused, by this or any later process, for as long as
+        the server takes it: then logging in is a single request. Whenever
+        the session expires, here or later on, the controller logs in again.
 
             :param username: username for authorisation
             :param password: password for authorisation
+            :param cookie_path: file to keep the session cookie in
+            :param cookie_max_age: seconds; older cookies in cookie_path aren't tried
             :returns: True if authorisation was successful, False otherwise
 
         """
+        self._credentials = (username, password)
+        self._cookie_path = cookie_path
+        state = read_snapshot(cookie_path, max_age=cookie_max_age) if cookie_path is not None else None
+        if state is not None and state.get('kind') == 'session' and state.get('url') == self.url \
+                and state.get('username') == username and state.get('cookie'):
+            self._set_auth_cookie(*state['cookie'])
+        elif not self._log_in(username, password):
+            return False
+
+        # A stale cookie gets a 401 here, and is replaced by _send
+        response = self._send('GET', self.url + type(self).account_url)
+        if response.status_code != 200:
+            return False
+        try:
+            self.account = json_loads(response.content)
+        except json.decoder.JSONDecodeError:
+            return False
+        if self._refreshed_at is None:
+            # Nothing fetched or loaded from a snapshot yet: fetch on first use
+            self._unloaded = set(type(self)._list_loaders)
+        if len(self.managed_school_list) == 1:
+            self.set_managed_school(self.managed_school_list[0])
+        return True
+
+    def _log_in(self, username, password):
         current_url = self.url + type(self).auth_url
 
-        response = requests.post(
+        # Not _send: a 401 here is an answer, not an expired session
+        response = self._send_once(
+            'POST',
             current_url,
-            json={'username': username, 'password': password}
+            data=json_dumps({'username': username, 'password': password}),
+            headers={'Content-Type': 'application/json'},
         )
 
-        self.cookies = response.cookies
-
         #
         # So, instead of Set-Cookie header, the server returns Cookie header
         # they also don't return any MaxAge, version, or anything, 'cause why bother
@@ -454,48 +1516,33 @@ class Controller(object):
             # Authentication error, or maybe just the stars weren't right
             return False
 
-        self.cookies.set(cookie_name, cookie_value)
+        self._set_auth_cookie(cookie_name, cookie_value)
+        self._auth_generation += 1
+        if self._cookie_path is not None:
+            write_snapshot(self._cookie_path, {
+                'kind': 'session',
+                'url': self.url,
+                'username': username,
+                'cookie': [cookie_name, cookie_value],
+            })
+        return True
 
-        current_url = self.url + type(self).account_url
-        response = requests.get(
-            current_url,
-            cookies=self.cookies,
-        )
-        try:
-            self.account = json.loads(response.text)
-            self._get_user_list()
-            self._get_class_list()
-            self._get_school_list()
-            if len(self.managed_school_list) == 1:
-                self.set_managed_school(self.managed_school_list[0])
-            return True
-        except json.decoder.JSONDecodeError:
+    def _reauthenticate(self, generation):
+        # Called by whoever first got a 401 with the session of that generation;
+        # everybody else waits for it and then just retries
+        if self._credentials is None:
             return False
-
-    @property
-    def login_list(self):
-        if self.user_list is not None:
-            return [x['login'] for x in self.user_list]
-        else:
-            return []
-
-    @property
-    def managed_school_list(self):
-        if self.account is not None and \
-                        'additionalUserInfoDTO' in self.account and \
-                        'adminSchools' in self.account['additionalUserInfoDTO']:
-            return [x['id'] for x in self.account['additionalUserInfoDTO']['adminSchools']]
-        else:
-            return []
-
-    @property
-    def managed_school_detail(self):
-        for school in self.school_list:
-            if school['id'] == self.managed_school:
-                return school
-        return {}
+        with self._auth_lock:
+            if self._auth_generation != generation:
+                return True
+            return self._log_in(*self._credentials)
 
     def user_for_login(self, login):
-        if login not in self.login_list:
+        if not self.has_login(login):
             raise UserDoesNotExist()
-        return [x for x in self.user_list if x['login'] == login][0]
+        if 'id' not in self._users_by_login[login]:
+            # Created by us, but the server didn't tell us the id
+            self._get_user_list()
+            if login not in self._users_by_login:
+                raise UserDoesNotExist()
+        return self._users_by_login[login]
@@ -0,0 +1,301 @@
+import heapq
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class EventStream(object):
+    """Sends import events to sinks.
+
+    An event is a dict: time, phase ('plan', 'users', 'classes', 'members',
+    'prune'), key (user or class key), action (the operation kind),
+    status ('created', 'updated', 'activated', 'repaired', 'deactivated',
+    'deleted', 'unchanged', 'failed', 'missing' or, for phase 'plan',
+    'planned'), duration (seconds the operation took), and for some
+    statuses a message. A sink is any callable taking an event; if it has
+    flush() or close(), they're called by the stream's.
+    Sinks are called from whatever thread the operation ran in.
+
+        :param sinks: list of sinks, a ConsoleSink if omitted
+
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks) if sinks is not None else [ConsoleSink()]
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, event):
+        event.setdefault('time', time.time())
+        for sink in self.sinks:
+            sink(event)
+
+    def flush(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'flush'):
+                sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+def format_event(event):
+    """One line about an event, for people."""
+    if event['status'] == 'planned':
+        return "{operations} operations planned, {unchanged} up to date, {journaled} done before".format(**event)
+    line = "{}: {}".format(event.get('key'), event['status'])
+    if event['status'] in ('failed', 'missing') and event.get('action'):
+        line += " ({})".format(event['action'])
+    if event.get('message'):
+        line += ": {}".format(event['message'])
+    return line
+
+
+class ConsoleSink(object):
+    """Writes format_event lines to a stream (stdout by default), a batch at a time.
+
+        :param stream: text file object, or a file name (appended to)
+        :param flush_every: seconds lines may wait for the next write
+
+    """
+
+    def __init__(self, stream=None, flush_every=1.0):
+        self._owned = isinstance(stream, str)
+        self.stream = open(stream, 'a', encoding='utf-8') if self._owned else stream
+        self.flush_every = flush_every
+        self._lines = []
+        self._written_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._lines.append(format_event(event))
+            if time.monotonic() - self._written_at < self.flush_every:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+            self._written_at = time.monotonic()
+            if lines:
+                stream = self.stream if self.stream is not None else sys.stdout
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+
+    def close(self):
+        self.flush()
+        if self._owned:
+            self.stream.close()
+
+
+class LoggingSink(object):
+    """Logs format_event lines; failures and missing users as warnings.
+
+        :param logger: logging.Logger, 'MobEduInterface.import' by default
+
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger('MobEduInterface.import')
+        self.level = level
+
+    def __call__(self, event):
+        level = logging.WARNING if event['status'] in ('failed', 'missing') else self.level
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, format_event(event))
+
+
+class JsonLinesSink(object):
+    """Writes every event as a line of JSON, buffer_size events at a time.
+
+        :param target: file name (appended to) or a text file object
+
+    """
+
+    def __init__(self, target, buffer_size=100):
+        if isinstance(target, str):
+            self.file = open(target, 'a', encoding='utf-8')
+            self._owned = True
+        else:
+            self.file = target
+            self._owned = False
+        self.buffer_size = buffer_size
+        self._lines = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str, separators=(',', ':'))
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) < self.buffer_size:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+            if lines:
+                self.file.write("\n".join(lines) + "\n")
+                self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self._owned:
+            self.file.close()
+
+
+class BackgroundSink(object):
+    """Runs another sink in a thread of its own, so that slow output doesn't hold up imports.
+
+    Once closed, events go to the sink right away.
+
+        :param sink: the sink to run
+        :param max_queue: events waiting at most; emitting blocks beyond that
+
+    """
+
+    _stop = object()
+
+    def __init__(self, sink, max_queue=10000):
+        self.sink = sink
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name='BackgroundSink', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                if event is type(self)._stop:
+                    return
+                self.sink(event)
+            except Exception:
+                logging.getLogger('MobEduInterface.import').exception("Event sink failed")
+            finally:
+                self._queue.task_done()
+
+    def __call__(self, event):
+        if self._thread.is_alive():
+            self._queue.put(event)
+        else:
+            self.sink(event)
+
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.join()
+        if hasattr(self.sink, 'flush'):
+            self.sink.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(type(self)._stop)
+            self._thread.join()
+        if hasattr(self.sink, 'close'):
+            self.sink.close()
+
+
+class ImportReport(object):
+    """Counts, throughput, ETA and the slowest operations of a run, kept up from its events.
+
+        :param slowest: how many of the slowest operations to keep
+
+    """
+
+    def __init__(self, slowest=10):
+        self.keep_slowest = slowest
+        self.total = 0
+        self.done = 0
+        self.statuses = Counter()
+        self.phases = {}
+        self.started = None
+        self.last = None
+        self._slowest = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            now = event.get('time', time.time())
+            if self.started is None:
+                self.started = now
+            self.last = now
+            if event['status'] == 'planned':
+                self.total += event['operations']
+                return
+            self.statuses[event['status']] += 1
+            phase = self.phases.setdefault(event.get('phase'), Counter())
+            phase[event['status']] += 1
+            if 'duration' not in event:
+                # Not an operation of the plan, e.g. a missing member
+                return
+            self.done += 1
+            item = (event['duration'], self.done, event)
+            if len(self._slowest) < self.keep_slowest:
+                heapq.heappush(self._slowest, item)
+            elif item[0] > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return max(0.0, time.time() - self.started) if self.done < self.total else self.last - self.started
+
+    @property
+    def rate(self):
+        """Operations per second so far."""
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Seconds until every planned operation is done, at the current rate; None if unknown."""
+        if self.done >= self.total:
+            return 0.0
+        rate = self.rate
+        return (self.total - self.done) / rate if rate > 0 else None
+
+    @property
+    def slowest(self):
+        """The slowest operations' events, slowest first."""
+        with self._lock:
+            return [event for duration, n, event in sorted(self._slowest, reverse=True)]
+
+    def summary(self):
+        """Everything as a plain dict."""
+        with self._lock:
+            statuses = dict(self.statuses)
+            phases = {phase: dict(counts) for phase, counts in self.phases.items()}
+        return {
+            'planned': self.total,
+            'done': self.done,
+            'statuses': statuses,
+            'phases': phases,
+            'elapsed': self.elapsed,
+            'rate': self.rate,
+            'eta': self.eta,
+            'slowest': [{k: event.get(k) for k in ('phase', 'key', 'action', 'status', 'duration')}
+                        for event in self.slowest],
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        lines = ["{done} of {planned} operations in {elapsed:.1f} s, {rate:.1f}/s".format(**summary)]
+        if summary['eta']:
+            lines[0] += ", about {:.0f} s to go".format(summary['eta'])
+        if summary['statuses']:
+            lines.append(", ".join("{} {}".format(count, status)
+                                   for status, count in sorted(summary['statuses'].items())))
+        for event in summary['slowest']:
+            lines.append("  {duration:.3f} s  {key}: {action} {status}".format(**event))
+        return "\n".join(lines)
@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AdaptiveLimiter(object):
+    """Adaptive limit on requests in flight (additive increase, multiplicative decrease).
+
+    The limit is halved and new requests are held back for a growing backoff
+    whenever the server answers 429 or 5xx (or doesn't answer at all). When the
+    average latency climbs above latency_factor times the baseline, the limit
+    goes down by one. Otherwise it goes up by one every `limit` successful
+    requests, up to max_concurrency. The baseline is the lowest average seen,
+    creeping up by 1% a request so that one lucky request doesn't pin it.
+    """
+
+    warmup = 10
+
+    retry_statuses = (429, 502, 503, 504)
+    retry_methods = ('GET', 'PUT', 'DELETE')
+
+    def __init__(self, max_concurrency=8, min_concurrency=1, latency_factor=3.0,
+                 backoff=0.5, max_backoff=60.0, max_retries=5):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self.latency_factor = latency_factor
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.overloads = 0
+        self._active = 0
+        self._samples = 0
+        self._seen = 0
+        self._latency = None
+        self._best_latency = None
+        self._paused_until = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                elif self._active >= self.limit:
+                    self._condition.wait()
+                else:
+                    break
+            self._active += 1
+
+    def release(self, status_code, latency, retry_after=None):
+        """Account for a finished request.
+
+            :param status_code: HTTP status, None if the request failed altogether
+            :param latency: seconds the request took
+            :param retry_after: seconds the server asked us to wait, if it did
+
+        """
+        with self._condition:
+            self._active -= 1
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self._overloaded(retry_after)
+            else:
+                self.backoff = self.initial_backoff
+                self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+                self._seen += 1
+                if self._seen >= type(self).warmup:
+                    self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self):
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+        else:
+            self._best_latency *= 1.01
+        self._samples += 1
+        if self._samples >= self.limit:
+            # Adjust at most once per `limit` requests
+            self._samples = 0
+            if self._latency > self.latency_factor * self._best_latency:
+                self.limit = max(self.min_concurrency, self.limit - 1)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1)
+
+    def _overloaded(self, retry_after):
+        self.overloads += 1
+        self.limit = max(self.min_concurrency, self.limit // 2)
+        self._samples = 0
+        delay = retry_after if retry_after is not None else self.backoff
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self.backoff = min(self.max_backoff, self.backoff * 2)
+
+    def should_retry(self, method, status_code, attempt):
+        # POSTs are never retried, a lost response doesn't mean nothing was created
+        return method in type(self).retry_methods and \
+            (status_code is None or status_code in type(self).retry_statuses) and \
+            attempt < self.max_retries
+
+
+class ImportExecutor(object):
+    """Runs independent import operations on a bounded thread pool."""
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+
+    def map(self, fn, items):
+        """Like map(), but concurrent. Results come back in order, the first exception is raised."""
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [fn(x) for x in items]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(fn, items))
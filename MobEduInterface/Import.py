@@ -1,8 +1,15 @@
+import asyncio
 import ldap3
-import random
-from .Controller import UserExists, ClassExists, OperationalError, UserDoesNotExist
+import time
+from ldap3.utils.conv import escape_filter_chars
+from .Controller import Controller, UserExists, ClassExists, OperationalError, UserDoesNotExist, \
+    PruneThresholdExceeded
+from .Events import EventStream, ImportReport
+from .Mapping import MappedRecord
+from .Passwords import PasswordGenerator, password_characters
+from .Plan import Operation, PrunePlan, SyncPlan
 
-random_password_characters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890"
+random_password_characters = password_characters
 
 
 class Importer(object):
@@ -21,27 +28,244 @@ class Importer(object):
     def get_class_user_keys(self, e_class):
         raise NotImplementedError
 
-    def do_import(self, controller):
+    def get_known_user_logins(self):
+        """Logins of users get_users() leaves out, by user key; see LdapImporter's change_tracker."""
+        return {}
+
+    def get_known_classes(self):
+        """Mapped classes get_classes() leaves out, like get_known_user_logins."""
+        return []
+
+    def import_done(self, plan):
+        """Called after a plan has been executed without an exception."""
+        pass
+
+    def planned_object(self, obj, kind):
+        """What an operation keeps of a user or class until the plan is executed.
+
+            :param kind: 'users' or 'classes'
+            :returns: obj itself, unless an importer has something smaller that maps the same
+
+        """
+        return obj
+
+    def plan_import(self, controller, journal=None, events=None):
+        """Compare importer objects with the controller cache and plan what has to change.
+
+            :param controller: authenticated Controller
+            :param journal: ImportJournal of an interrupted run; whatever it has as done is skipped
+            :param events: EventStream the plan reports to when executed, see SyncPlan
+            :returns: SyncPlan
+
+        """
+        if not isinstance(controller, Controller):
+            raise TypeError("Import plans need a Controller; use do_import_async with an AsyncController")
+        plan = SyncPlan(journal=journal, events=events)
+        plan.known_logins = self.get_known_user_logins()
+
+        with controller.metrics.phase('plan_users'):
+            for user in self.get_users():
+                user_key = self.get_user_key(user)
+                if journal is not None and journal.done(user_key, 'user') \
+                        and journal.get(user_key, 'user').get('id') is not None:
+                    plan.user_ids[user_key] = journal.get(user_key, 'user')['id']
+                    plan.journaled += 1
+                    continue
+                plan.add_user_key(controller, user_key, user)
+                action, changes = controller.diff_user(user)
+                if action is None:
+                    plan.unchanged_users += 1
+                else:
+                    plan.user_operations.append(Operation(action + '_user', user_key,
+                                                          self.planned_object(user, 'users'), changes))
+
+        with controller.metrics.phase('plan_classes'):
+            for e_class in self.get_classes():
+                class_key = self.get_class_key(e_class)
+                if journal is not None and journal.done(class_key, 'members'):
+                    plan.journaled += 1
+                    continue
+                action, changes = controller.diff_class(e_class)
+
+                user_keys = list(self.get_class_user_keys(e_class))
+                planned = self.planned_object(e_class, 'classes')
+                if action == 'create':
+                    current = None
+                else:
+                    group_obj = controller.get_class_group(e_class)
+                    if group_obj is None:
+                        # The class was created, but its group wasn't
+                        if action is None:
+                            action, changes = 'repair', ['userGroup']
+                        current = None
+                    else:
+                        current = group_obj['userIds']
+
+                if action is None:
+                    plan.unchanged_classes += 1
+                else:
+                    plan.class_operations.append(Operation(action + '_class', class_key, planned, changes))
+
+                members, unresolved = plan.resolve_member_ids(controller, user_keys, warn=False)
+                if current is None or unresolved or set(members) != set(current):
+                    plan.member_operations.append(Operation('set_members', class_key, planned,
+                                                            user_keys=user_keys, current=current))
+                else:
+                    plan.settled_classes.append(class_key)
+
+        return plan
+
+    def do_import(self, controller, dry_run=False, executor=None, journal=None, resume=False, events=None):
+        """Plan an import and execute it.
+
+            :param controller: authenticated Controller
+            :param dry_run: only print the plan, don't change anything
+            :param executor: ImportExecutor to run independent operations concurrently
+            :param journal: ImportJournal to record finished operations in
+            :param resume: continue the run recorded in journal instead of starting afresh
+            :param events: EventStream to report every operation to; printed to stdout by default
+            :returns: the SyncPlan; plan.report sums up how it went
+
+        """
+        if journal is not None and not resume and not dry_run:
+            journal.reset()
+        plan = self.plan_import(controller, journal=journal, events=events)
+        if dry_run:
+            print(plan.describe())
+        else:
+            plan.execute(controller, executor=executor)
+            self.import_done(plan)
+        return plan
+
+    def plan_prune(self, controller, action='deactivate', keep=None, events=None):
+        """Plan removing users and classes of the managed school that the importer doesn't have.
+
+        Only users with nothing but student or teacher roles are candidates, and
+        never the account we're logged in with. With a change tracker, run this
+        after do_import, so that the tracker knows every current user.
+
+            :param controller: authenticated Controller
+            :param action: 'deactivate' or 'delete' users; classes are always deleted
+            :param keep: callable(remote user) -> True for more users to leave alone
+            :returns: PrunePlan
+
+        """
+        if action not in ('deactivate', 'delete'):
+            raise ValueError("action must be 'deactivate' or 'delete'")
+        if not isinstance(controller, Controller):
+            raise TypeError("Prune plans need a Controller")
+        logins = set(self.get_known_user_logins().values())
+        logins.update(controller.user_login(user) for user in self.get_users())
+        class_keys = {controller._class_key(x) for x in self.get_known_classes()}
+        class_keys.update(controller.class_key_for(e_class) for e_class in self.get_classes())
+
+        managed_roles = set(controller.student_roles) | set(controller.teacher_roles)
+        account_login = (controller.account or {}).get('login')
+        remote_users = [x for x in controller.user_list if controller.in_managed_school(x)]
+        remote_classes = [x for x in controller.class_list if controller.in_managed_school(x)]
+        plan = PrunePlan(len(remote_users), len(remote_classes), events=events)
+
+        for remote_user in remote_users:
+            login = remote_user.get('login')
+            if login is None or login in logins or login == account_login:
+                continue
+            if not set(remote_user.get('roles') or []) <= managed_roles:
+                continue
+            if keep is not None and keep(remote_user):
+                continue
+            if action == 'deactivate':
+                if remote_user.get('active') is False or remote_user.get('activated') is False:
+                    continue
+                plan.user_operations.append(Operation('deactivate_user', login, remote_user))
+            else:
+                plan.user_operations.append(Operation('delete_user', login, remote_user))
+
+        for remote_class in remote_classes:
+            if controller._class_key(remote_class) not in class_keys:
+                plan.class_operations.append(
+                    Operation('delete_class', remote_class.get('name', remote_class.get('id')), remote_class))
+        return plan
+
+    def do_prune(self, controller, dry_run=False, action='deactivate', max_fraction=0.1, force=False,
+                 executor=None, keep=None, refresh=False, events=None):
+        """Remove remote users and classes the importer doesn't have, see plan_prune.
+
+            :param dry_run: only print what would be removed
+            :param max_fraction: refuse (PruneThresholdExceeded) to remove more than this share
+                                 of the school's users or classes, in case the importer came up
+                                 short, e.g. because of an LDAP hiccup
+            :param force: go ahead whatever max_fraction says
+            :param executor: ImportExecutor to send removals concurrently
+            :param refresh: refetch the lists once at the end
+            :param events: EventStream to report every removal to
+            :returns: the PrunePlan
+
+        """
+        plan = self.plan_prune(controller, action=action, keep=keep, events=events)
+        if dry_run:
+            print(plan.describe())
+            try:
+                plan.check_threshold(max_fraction)
+            except PruneThresholdExceeded as e:
+                print("!!! {} !!!".format(e))
+            return plan
+        if not force:
+            plan.check_threshold(max_fraction)
+        plan.execute(controller, executor=executor, refresh=refresh)
+        return plan
+
+    async def do_import_async(self, controller, events=None):
+        """Same as do_import, for an AsyncController.
+
+        Users are created/updated concurrently, then classes are created/updated
+        and get their members concurrently. Concurrency is bounded by the controller.
+
+            :param events: EventStream, as for do_import
+            :returns: ImportReport
+
+        """
         user_by_key = {}
+        events = events if events is not None else EventStream()
+        report = ImportReport()
 
-        for user in self.get_users():
-            user_by_key[self.get_user_key(user)] = user
+        def emit(phase, key, action, status, started=None, **data):
+            event = {'time': time.time(), 'phase': phase, 'key': key, 'action': action, 'status': status}
+            if started is not None:
+                event['duration'] = time.monotonic() - started
+            event.update(data)
+            report(event)
+            events.emit(event)
+
+        async def import_user(user):
+            started = time.monotonic()
             try:
-                print("{}: {}".format(self.get_user_key(user),
-                                      controller.create_user(user, teacher=user["is_teacher"], skip_update=True)))
+                result = await controller.create_user(user, teacher=user["is_teacher"], skip_update=True)
+                status = 'created'
             except UserExists:
-                print("{}: update {}".format(self.get_user_key(user),
-                                      controller.update_user(user)))
+                result = await controller.update_user(user)
+                status = 'updated'
+            emit('users', self.get_user_key(user), 'create_user', status if result else 'failed', started)
+
+        users = []
+        for user in self.get_users():
+            user_by_key[self.get_user_key(user)] = user
+            users.append(import_user(user))
+        classes = list(self.get_classes())
+        # A user is one operation, a class two: itself and its members
+        emit('plan', None, None, 'planned', operations=len(users) + 2 * len(classes), unchanged=0, journaled=0)
+        await asyncio.gather(*users)
 
-        controller._get_user_list()
+        await controller._get_user_list()
 
-        for e_class in self.get_classes():
+        async def import_class(e_class):
+            started = time.monotonic()
             try:
-                print("{}: {}".format(self.get_class_key(e_class),
-                                      controller.create_class(e_class)))
-            except ClassExists as e:
-                print("{}: update {}".format(self.get_class_key(e_class),
-                                             controller.update_class(e_class)))
+                result = await controller.create_class(e_class)
+                status = 'created'
+            except ClassExists:
+                result = await controller.update_class(e_class)
+                status = 'updated'
+            emit('classes', self.get_class_key(e_class), 'create_class', status if result else 'failed', started)
 
             members = []
             for user_key in self.get_class_user_keys(e_class):
@@ -52,29 +276,107 @@ class Importer(object):
                         user['id'] = id
                     else:
                         try:
-                            old_user = controller._get_user_object(user)
+                            old_user = await controller._get_user_object(user)
                             user['id'] = old_user['id']
                         except UserDoesNotExist:
-                            print("!!! WARNING !!!")
-                            print("User not found.")
-                            print(user)
-                            print("!!! WARNING !!!")
+                            emit('members', user_key, None, 'missing', message="User not found")
+                            continue
 
                 members.append(user['id'])
 
+            started = time.monotonic()
             try:
-                controller.set_class_members(e_class, members)
-                print("{}: set members OK".format(self.get_class_key(e_class)))
+                await controller.set_class_members(e_class, members)
+                status = 'updated'
             except OperationalError:
-                print("{}: set members OPERATIONAL ERROR".format(self.get_class_key(e_class)))
+                status = 'failed'
+            emit('members', self.get_class_key(e_class), 'set_members', status, started)
+
+        try:
+            await asyncio.gather(*[import_class(e_class) for e_class in classes])
+        finally:
+            events.flush()
+        return report
+
+
+class LdapObject(MappedRecord):
+    """An LDAP entry as a dict of ", "-joined attribute values.
+
+    Values are converted on first access. 'original' (the ldap3 entry) and 'dn'
+    are always there; anything the importer sets (password, is_teacher, id)
+    is a plain dict item. Mapped forms are remembered, see MappedRecord.
+    """
+
+    def __init__(self, entry):
+        super(LdapObject, self).__init__()
+        self._raw = entry['attributes']
+        self['original'] = entry
+        self['dn'] = entry['dn']
+
+    def __missing__(self, key):
+        # ldap3 hands out requested attributes the entry doesn't have as empty lists
+        if key not in self._raw or (isinstance(self._raw[key], list) and not self._raw[key]):
+            raise KeyError(key)
+        try:
+            value = ", ".join(self._raw[key])
+        except (TypeError, ValueError):
+            raise KeyError(key)
+        # Not self[key] = value: converting a value doesn't change the record
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def load_all(self):
+        for key in self._raw:
+            key in self
+        return self
 
 
 class LdapImporter(Importer):
+    # Set by the importer itself, never read from the directory
+    local_attributes = {'original', 'dn', 'password', 'is_teacher', 'id'}
+
     def __init__(self, ldap_connection, base, scope=ldap3.SUBTREE,
                  check_if_teacher=None,
                  user_filter="(objectClass=inetOrgPerson)",
                  class_filter="(objectClass=groupOfNames)",
-                 attributes=ldap3.ALL_ATTRIBUTES):
+                 attributes=ldap3.ALL_ATTRIBUTES,
+                 page_size=None,
+                 project_attributes=False,
+                 extra_user_attributes=(),
+                 extra_class_attributes=(),
+                 controller_class=Controller,
+                 change_tracker=None,
+                 password_generator=None):
+        """
+            :param page_size: if set, search with the paged results control, page_size
+                              entries at a time, and return users and classes as generators
+            :param project_attributes: instead of `attributes`, only ask for what controller_class
+                                       mappings read, and convert attribute values lazily
+            :param extra_user_attributes: attributes to fetch for users on top of the mapped ones,
+                                          e.g. whatever a callable check_if_teacher looks at
+            :param extra_class_attributes: same for classes
+            :param controller_class: Controller (sub)class whose mappings are used for projection
+            :param change_tracker: ChangeTracker; if given, only entries changed since the last
+                                   successful import are returned, and deleted_users() and
+                                   deleted_classes() tell what's gone
+            :param password_generator: PasswordGenerator for the placeholder passwords new users get
+
+        """
         super(LdapImporter, self).__init__()
         self.connection = ldap_connection
         self.user_filter = user_filter
@@ -83,44 +385,182 @@ class LdapImporter(Importer):
         self.scope = scope
         self.attributes = attributes
         self.check_if_teacher = check_if_teacher
+        self.page_size = page_size
+        self.project_attributes = project_attributes
+        self.controller_class = controller_class
+        self.change_tracker = change_tracker
+        self.password_generator = password_generator if password_generator is not None else PasswordGenerator()
+        if project_attributes:
+            user_attributes = controller_class.mapping_attributes(controller_class.default_user_mappings)
+            user_attributes |= set(extra_user_attributes)
+            if check_if_teacher is not None and not callable(check_if_teacher):
+                user_attributes.add(str(check_if_teacher))
+            class_attributes = controller_class.mapping_attributes(controller_class.default_class_mappings)
+            class_attributes |= controller_class.mapping_attributes(controller_class.default_group_mappings)
+            class_attributes |= set(extra_class_attributes)
+            class_attributes.add('member')
+            self.user_attributes = self._known_attributes(user_attributes)
+            self.class_attributes = self._known_attributes(class_attributes)
+        else:
+            self.user_attributes = attributes
+            self.class_attributes = attributes
+        # What planned_object keeps: what the mappings read, and what the importer sets
+        self._planned_attributes = {
+            'users': controller_class.mapping_attributes(controller_class.default_user_mappings)
+            | type(self).local_attributes - {'original'},
+            'classes': controller_class.mapping_attributes(controller_class.default_class_mappings)
+            | controller_class.mapping_attributes(controller_class.default_group_mappings)
+            | type(self).local_attributes - {'original'},
+        }
+        if change_tracker is not None and change_tracker.timestamp_attribute is not None:
+            # Operational attributes only come back when asked for by name
+            self.user_attributes = type(self)._with_attribute(self.user_attributes,
+                                                             change_tracker.timestamp_attribute)
+            self.class_attributes = type(self)._with_attribute(self.class_attributes,
+                                                              change_tracker.timestamp_attribute)
 
-    def get_objects(self, current_filter, do_teacher_check = False):
-        results = []
+    def planned_object(self, obj, kind):
+        # On a first sync every user gets an operation; keeping the ldap3 entries
+        # (and every attribute they carry) until execute() would undo the paging
+        planned = MappedRecord((x, obj[x]) for x in self._planned_attributes[kind] if x in obj)
+        planned.mapping_memo.update(getattr(obj, 'mapping_memo', {}))
+        return planned
 
-        for base in self.base:
-            self.connection.search(
+    @staticmethod
+    def _with_attribute(attributes, attribute):
+        if isinstance(attributes, str):
+            attributes = [attributes]
+        attributes = list(attributes)
+        if attribute not in attributes:
+            attributes.append(attribute)
+        return attributes
+
+    def _known_attributes(self, attributes):
+        attributes = set(attributes) - type(self).local_attributes
+        schema = getattr(self.connection.server, 'schema', None)
+        if schema is not None and schema.attribute_types:
+            # ldap3 refuses to ask for attributes the schema doesn't know
+            known = {x.lower() for x in schema.attribute_types}
+            attributes = {x for x in attributes if x.lower() in known}
+        return sorted(attributes)
+
+    def _search(self, base, current_filter, attributes):
+        if self.page_size:
+            # Paged results control: the server hands out page_size entries at a time,
+            # and ldap3 fetches the next page only when we get to it
+            return self.connection.extend.standard.paged_search(
                 base,
                 current_filter,
                 search_scope=self.scope,
-                attributes=self.attributes
+                attributes=attributes,
+                paged_size=self.page_size,
+                generator=True,
             )
-            for entry in self.connection.response:
-                attributes = {'original': entry}
-                for k in entry['attributes']:
-                    try:
-                        attributes[k] = ", ".join(entry['attributes'][k])
-                    except (TypeError, ValueError):
-                        pass
-                attributes['dn'] = entry['dn']
-
-                # We add a fake password. It has to be set later by user
-                attributes['password'] = "".join([random.choice(random_password_characters) for x in range(30)])
-
-                if do_teacher_check:
-                    if self.check_if_teacher is None:
-                        attributes['is_teacher'] = False
-                    elif callable(self.check_if_teacher):
-                        attributes['is_teacher'] = bool(self.check_if_teacher(entry))
-                    else:
-                        attributes['is_teacher'] = bool(attributes[str(self.check_if_teacher)])
-                results.append(attributes)
-        return results
+        self.connection.search(
+            base,
+            current_filter,
+            search_scope=self.scope,
+            attributes=attributes
+        )
+        return self.connection.response
+
+    def _make_object(self, entry, do_teacher_check=False):
+        attributes = LdapObject(entry)
+        if not self.project_attributes:
+            attributes.load_all()
+
+        # We add a fake password. It has to be set later by user
+        attributes['password'] = self.password_generator.generate()
+
+        if do_teacher_check:
+            if self.check_if_teacher is None:
+                attributes['is_teacher'] = False
+            elif callable(self.check_if_teacher):
+                attributes['is_teacher'] = bool(self.check_if_teacher(entry))
+            else:
+                attributes['is_teacher'] = bool(attributes[str(self.check_if_teacher)])
+        return attributes
+
+    def iter_objects(self, current_filter, do_teacher_check=False, attributes=None, kind=None):
+        """Entries matching current_filter as LdapObjects.
+
+            :param kind: 'users' or 'classes'; with a change_tracker, only new and changed
+                         entries of that kind are returned
+
+        """
+        if attributes is None:
+            attributes = self.attributes
+        tracker = self.change_tracker if kind is not None else None
+        if tracker is not None and tracker.can_filter():
+            # Let the server skip entries older than the watermark; a search without
+            # attributes still tells which entries exist, for deletions
+            for base in self.base:
+                for entry in self._search(base, current_filter, ldap3.NO_ATTRIBUTES):
+                    if entry.get('type', 'searchResEntry') == 'searchResEntry':
+                        tracker.seen(kind, entry['dn'])
+            current_filter = "(&{}({}>={}))".format(
+                current_filter, tracker.timestamp_attribute, escape_filter_chars(tracker.watermark))
+        for base in self.base:
+            for entry in self._search(base, current_filter, attributes):
+                if entry.get('type', 'searchResEntry') != 'searchResEntry':
+                    # Referrals and such
+                    continue
+                obj = self._make_object(entry, do_teacher_check)
+                if tracker is not None and not tracker.check(kind, entry['dn'], entry['attributes'],
+                                                             **self._tracked_data(kind, obj)):
+                    continue
+                yield obj
+        if tracker is not None:
+            tracker.finish(kind)
+
+    def _tracked_data(self, kind, obj):
+        # What deleted_users() and deleted_classes() give back
+        if kind == 'users':
+            return {'login': self.controller_class.user_login(obj)}
+        mapped = self.controller_class._map_object(obj, self.controller_class.default_class_mappings)
+        return {'class': {k: v for k, v in mapped.items() if k != 'id'}}
+
+    def get_objects(self, current_filter, do_teacher_check=False, attributes=None, kind=None):
+        if self.page_size:
+            return self.iter_objects(current_filter, do_teacher_check, attributes, kind)
+        return list(self.iter_objects(current_filter, do_teacher_check, attributes, kind))
 
     def get_users(self):
-        return self.get_objects(self.user_filter, do_teacher_check=True)
+        return self.get_objects(self.user_filter, do_teacher_check=True, attributes=self.user_attributes,
+                                kind='users')
 
     def get_classes(self):
-        return self.get_objects(self.class_filter)
+        return self.get_objects(self.class_filter, attributes=self.class_attributes, kind='classes')
+
+    def get_known_user_logins(self):
+        if self.change_tracker is None:
+            return {}
+        return {dn: stored['data']['login']
+                for dn, stored in self.change_tracker.entries.get('users', {}).items()}
+
+    def get_known_classes(self):
+        if self.change_tracker is None:
+            return []
+        return [stored['data']['class'] for stored in self.change_tracker.entries.get('classes', {}).values()]
+
+    def deleted_users(self):
+        """Users gone from LDAP since the last import, as {dn: login}; needs a change_tracker.
+
+        Complete once get_users() has been gone through.
+        """
+        if self.change_tracker is None:
+            return {}
+        return {dn: data['login'] for dn, data in self.change_tracker.deleted('users').items()}
+
+    def deleted_classes(self):
+        """Classes gone from LDAP since the last import, as {dn: mapped class}; see deleted_users."""
+        if self.change_tracker is None:
+            return {}
+        return {dn: data['class'] for dn, data in self.change_tracker.deleted('classes').items()}
+
+    def import_done(self, plan):
+        if self.change_tracker is not None:
+            self.change_tracker.commit(failed=plan.failed)
 
     def get_user_key(self, user):
         return user['dn']
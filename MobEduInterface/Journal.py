@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+
+
+class ImportJournal(object):
+    """Append-only journal of finished import operations.
+
+    One json object per line: {"key": ..., "op": ..., "data": {...}}, where key
+    is the importer key (the LDAP DN for LdapImporter) and op is one of
+    'user', 'class_created', 'class' or 'members'. A line is written and
+    flushed as soon as the operation is done, so after a crash the journal
+    tells what doesn't have to be done again. A torn last line is ignored.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._done = {}
+        self._lock = threading.Lock()
+        self._load()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self._done[(record['key'], record['op'])] = record.get('data') or {}
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def record(self, key, op, **data):
+        with self._lock:
+            self._file.write(json.dumps({'key': key, 'op': op, 'data': data}, separators=(',', ':')) + "\n")
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._done[(key, op)] = data
+
+    def done(self, key, op):
+        return (key, op) in self._done
+
+    def get(self, key, op):
+        return self._done.get((key, op))
+
+    def reset(self):
+        """Forget everything, for a run that starts from scratch."""
+        with self._lock:
+            self._file.seek(0)
+            self._file.truncate()
+            self._done = {}
+
+    def __len__(self):
+        return len(self._done)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
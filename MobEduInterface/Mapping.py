@@ -0,0 +1,96 @@
+class MappedRecord(dict):
+    """A dict that remembers how it was mapped.
+
+    CompiledMapping stores its result on the record, so one record is mapped
+    only once however many controller methods look at it. Setting or deleting
+    an item forgets the stored results.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MappedRecord, self).__init__(*args, **kwargs)
+        self.mapping_memo = {}
+
+    def __setitem__(self, key, value):
+        self.mapping_memo.clear()
+        super(MappedRecord, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.mapping_memo.clear()
+        super(MappedRecord, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self.mapping_memo.clear()
+        super(MappedRecord, self).update(*args, **kwargs)
+
+    def pop(self, *args):
+        self.mapping_memo.clear()
+        return super(MappedRecord, self).pop(*args)
+
+
+class CompiledMapping(object):
+    """A mapping table turned into a single function.
+
+    A mapping table is a set of (remote, local) pairs: local is either the name
+    of a local attribute, copied if present, or a callable taking the local
+    object. Fields are produced in remote name order, whatever order the set
+    iterates in.
+    """
+
+    def __init__(self, mappings):
+        self.mappings = tuple(sorted(mappings, key=lambda x: (str(x[0]), callable(x[1]), str(x[1]))))
+        self.fields = tuple(remote for remote, local in self.mappings)
+        self._map = self._compile(self.mappings)
+
+    @staticmethod
+    def _compile(mappings):
+        namespace = {}
+        lines = ["def _map(o):", "    obj = {}"]
+        for n, (remote, local) in enumerate(mappings):
+            namespace['r{}'.format(n)] = remote
+            if callable(local):
+                namespace['f{}'.format(n)] = local
+                lines.append("    obj[r{0}] = f{0}(o)".format(n))
+            else:
+                namespace['l{}'.format(n)] = local
+                lines.append("    if l{0} in o:".format(n))
+                lines.append("        obj[r{0}] = o[l{0}]".format(n))
+        lines.append("    return obj")
+        exec("\n".join(lines), namespace)
+        return namespace['_map']
+
+    def __call__(self, original_obj):
+        memo = getattr(original_obj, 'mapping_memo', None)
+        if memo is None:
+            return self._map(original_obj)
+        mapped = memo.get(self)
+        if mapped is None:
+            mapped = memo[self] = self._map(original_obj)
+        # Callers add to what they get
+        return dict(mapped)
+
+    def map_many(self, objects):
+        """Map every object, in one pass."""
+        map_one = self.__call__
+        return [map_one(x) for x in objects]
+
+
+_compiled = {}
+_compiled_by_id = {}
+
+
+def compile_mapping(mappings):
+    """CompiledMapping for a mapping table, compiled once per distinct table.
+
+    Tables are looked up by identity first, so a table shouldn't be changed
+    in place once it has been used; assign a new set instead.
+    """
+    entry = _compiled_by_id.get(id(mappings))
+    if entry is not None and entry[0] is mappings:
+        return entry[1]
+    key = frozenset(mappings)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compiled[key] = CompiledMapping(key)
+    # The table is kept referenced, so its id can't be reused
+    _compiled_by_id[id(mappings)] = (mappings, compiled)
+    return compiled
@@ -0,0 +1,92 @@
+import time
+from collections import OrderedDict
+from .Controller import OperationalError
+
+
+class MembershipBatch(object):
+    """Queue of group membership changes, sent with at most one PUT per group.
+
+    Changes are kept per class; flush() fetches each group once, applies
+    everything queued for it to the current userIds and only PUTs the groups
+    that actually change. Can be used as a context manager, which flushes
+    on a clean exit.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.errors = OrderedDict()
+        # Seconds each flushed group took, by class key
+        self.durations = {}
+        self._changes = OrderedDict()
+
+    def _entry(self, e_class, key=None):
+        if key is None:
+            key = self.controller.class_key_for(e_class)
+        if key not in self._changes:
+            self._changes[key] = {'e_class': e_class, 'set': None, 'add': [], 'remove': []}
+        return self._changes[key]
+
+    def set(self, e_class, user_ids, key=None):
+        entry = self._entry(e_class, key)
+        entry['set'] = list(user_ids)
+        entry['add'] = []
+        entry['remove'] = []
+
+    def add(self, e_class, user_id, key=None):
+        entry = self._entry(e_class, key)
+        entry['add'].append(user_id)
+        if user_id in entry['remove']:
+            entry['remove'].remove(user_id)
+
+    def remove(self, e_class, user_id, key=None):
+        entry = self._entry(e_class, key)
+        entry['remove'].append(user_id)
+        if user_id in entry['add']:
+            entry['add'].remove(user_id)
+
+    def __len__(self):
+        return len(self._changes)
+
+    @staticmethod
+    def apply(current, entry):
+        user_ids = list(entry['set']) if entry['set'] is not None else list(current)
+        for user_id in entry['add']:
+            if user_id not in user_ids:
+                user_ids.append(user_id)
+        remove = set(entry['remove'])
+        return [x for x in user_ids if x not in remove]
+
+    def _flush_one(self, item):
+        key, entry = item
+        started = time.monotonic()
+        try:
+            return key, self.controller.update_class_group(entry['e_class'],
+                                                           lambda current: self.apply(current, entry))
+        except OperationalError as e:
+            self.errors[key] = e
+            return key, None
+        finally:
+            self.durations[key] = time.monotonic() - started
+
+    def flush(self, executor=None):
+        """Send queued changes.
+
+            :param executor: ImportExecutor to update groups concurrently
+            :returns: OrderedDict of class key -> True if the group was updated,
+                      False if it was already as requested.
+                      Groups that failed are left out and put into self.errors instead
+
+        """
+        changes, self._changes = self._changes, OrderedDict()
+        if executor is None:
+            done = [self._flush_one(x) for x in changes.items()]
+        else:
+            done = executor.map(self._flush_one, changes.items())
+        return OrderedDict((key, result) for key, result in done if result is not None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,186 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+class EndpointStats(object):
+    __slots__ = ('count', 'errors', 'statuses', 'latency_sum', 'latency_max', 'buckets',
+                 'bytes_sent', 'bytes_received')
+
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.errors = 0
+        self.statuses = {}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * bucket_count
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+class RequestMetrics(object):
+    """Per-endpoint request counters, latency histograms and byte counts, plus phase timers.
+
+    Hooks are called with a dict for every request:
+    endpoint, method, url, status (None if the request failed), latency, bytes_sent, bytes_received.
+    """
+
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self.hooks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self._phases = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def observe(self, endpoint, method, url, status, latency, bytes_sent=0, bytes_received=0):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats(len(type(self).latency_buckets))
+            stats.count += 1
+            if status is None or status >= 400:
+                stats.errors += 1
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency_sum += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            for n, bound in enumerate(type(self).latency_buckets):
+                if latency <= bound:
+                    stats.buckets[n] += 1
+                    break
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+        if self.hooks:
+            event = {
+                'endpoint': endpoint,
+                'method': method,
+                'url': url,
+                'status': status,
+                'latency': latency,
+                'bytes_sent': bytes_sent,
+                'bytes_received': bytes_received,
+            }
+            for hook in list(self.hooks):
+                hook(event)
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of work: with metrics.phase('users'): ..."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + elapsed
+
+    @property
+    def total_requests(self):
+        return sum(x.count for x in self._endpoints.values())
+
+    def stats(self):
+        """Everything as a plain dict, see to_json."""
+        with self._lock:
+            endpoints = {}
+            for name, x in sorted(self._endpoints.items()):
+                cumulative = 0
+                histogram = []
+                for bound, n in zip(type(self).latency_buckets, x.buckets):
+                    cumulative += n
+                    histogram.append(['+Inf' if bound == float('inf') else bound, cumulative])
+                endpoints[name] = {
+                    'count': x.count,
+                    'errors': x.errors,
+                    'statuses': {str(k): v for k, v in sorted(x.statuses.items(), key=lambda i: str(i[0]))},
+                    'latency_sum': x.latency_sum,
+                    'latency_avg': x.latency_sum / x.count if x.count else 0.0,
+                    'latency_max': x.latency_max,
+                    'latency_histogram': histogram,
+                    'bytes_sent': x.bytes_sent,
+                    'bytes_received': x.bytes_received,
+                }
+            return {
+                'requests': sum(x.count for x in self._endpoints.values()),
+                'endpoints': endpoints,
+                'phases': dict(self._phases),
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.stats(), **kwargs)
+
+    def to_prometheus(self, prefix='mobedu'):
+        """Prometheus text exposition format."""
+        stats = self.stats()
+        lines = [
+            "# HELP {}_requests_total Requests sent, by endpoint and status".format(prefix),
+            "# TYPE {}_requests_total counter".format(prefix),
+        ]
+        for name, x in stats['endpoints'].items():
+            for status, n in x['statuses'].items():
+                lines.append('{}_requests_total{{endpoint="{}",status="{}"}} {}'.format(prefix, name, status, n))
+        lines += [
+            "# HELP {}_request_duration_seconds Request latency".format(prefix),
+            "# TYPE {}_request_duration_seconds histogram".format(prefix),
+        ]
+        for name, x in stats['endpoints'].items():
+            for bound, n in x['latency_histogram']:
+                lines.append('{}_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                    prefix, name, bound, n))
+            lines.append('{}_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(prefix, name, x['latency_sum']))
+            lines.append('{}_request_duration_seconds_count{{endpoint="{}"}} {}'.format(prefix, name, x['count']))
+        lines += [
+            "# HELP {}_bytes_total Request and response body bytes".format(prefix),
+            "# TYPE {}_bytes_total counter".format(prefix),
+        ]
+        for name, x in stats['endpoints'].items():
+            lines.append('{}_bytes_total{{endpoint="{}",direction="sent"}} {}'.format(prefix, name, x['bytes_sent']))
+            lines.append('{}_bytes_total{{endpoint="{}",direction="received"}} {}'.format(
+                prefix, name, x['bytes_received']))
+        lines += [
+            "# HELP {}_phase_seconds Time spent in import phases".format(prefix),
+            "# TYPE {}_phase_seconds gauge".format(prefix),
+        ]
+        for name, seconds in sorted(stats['phases'].items()):
+            lines.append('{}_phase_seconds{{phase="{}"}} {}'.format(prefix, name, seconds))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Short human readable table."""
+        stats = self.stats()
+        lines = ["{:<16} {:>7} {:>6} {:>9} {:>9} {:>11}".format(
+            'endpoint', 'count', 'errors', 'avg ms', 'max ms', 'bytes in')]
+        for name, x in stats['endpoints'].items():
+            lines.append("{:<16} {:>7} {:>6} {:>9.1f} {:>9.1f} {:>11}".format(
+                name, x['count'], x['errors'], x['latency_avg'] * 1000, x['latency_max'] * 1000, x['bytes_received']))
+        for name, seconds in sorted(stats['phases'].items()):
+            lines.append("phase {:<10} {:.2f}s".format(name, seconds))
+        return "\n".join(lines)
+
+
+class EndpointClassifier(object):
+    """Names requests by matching them against a controller's url templates."""
+
+    def __init__(self, endpoints):
+        # endpoints: iterable of (name, method, url template)
+        self._patterns = []
+        for name, method, template in endpoints:
+            pattern = re.sub(r'\\\{[^}]*\\\}', '[^/?&]+', re.escape(template))
+            self._patterns.append((method, re.compile(pattern + r'$'), name))
+
+    def __call__(self, method, path):
+        for pattern_method, pattern, name in self._patterns:
+            if pattern_method == method and pattern.match(path):
+                return name
+        return 'other'
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from .Executor import ImportExecutor
+
+
+class MultiSchoolImport(object):
+    """Imports into several schools of one account at once.
+
+    One authenticated controller is shared: every school gets a view of it
+    (Controller.for_school) with its own managed_school, and the same session,
+    cached lists and detail cache. Schools are planned and executed in
+    parallel, phase by phase, so that every school's users exist before any
+    school sets class members.
+
+    A user (by login) that comes up in several schools is created or updated
+    by the first school that has it, in the order importers are given; the
+    other schools only put it into their classes, instead of moving it from
+    school to school.
+    """
+
+    def __init__(self, controller, importers, executor=None, school_concurrency=None, events=None):
+        """
+            :param controller: authenticated Controller
+            :param importers: {school id: Importer}, or a list of pairs; order decides
+                              which school owns users several of them have
+            :param executor: ImportExecutor each school uses for its operations
+            :param school_concurrency: how many schools are worked on at once, all by default
+            :param events: EventStream every school reports to; each plan has a report of its own
+
+        """
+        self.controller = controller
+        self.importers = OrderedDict(importers)
+        self.executor = executor
+        self.events = events
+        self.school_executor = ImportExecutor(school_concurrency or len(self.importers) or 1)
+        self.controllers = OrderedDict(
+            (school_id, controller.for_school(school_id)) for school_id in self.importers)
+        self.plans = OrderedDict()
+        self.shared_users = 0
+
+    def _map_schools(self, fn):
+        return OrderedDict(zip(self.importers, self.school_executor.map(fn, list(self.importers))))
+
+    def plan(self, journals=None):
+        """Plan every school.
+
+            :param journals: {school id: ImportJournal}, see Importer.plan_import
+            :returns: {school id: SyncPlan}
+
+        """
+        journals = journals or {}
+        self.plans = self._map_schools(lambda school_id: self.importers[school_id].plan_import(
+            self.controllers[school_id], journal=journals.get(school_id), events=self.events))
+        self._share_users()
+        return self.plans
+
+    def _share_users(self):
+        claimed = set()
+        self.shared_users = 0
+        for plan in self.plans.values():
+            ours = set(plan.user_logins.values()) | set(plan.known_logins.values())
+            keep = []
+            for op in plan.user_operations:
+                login = plan.user_logins.get(op.key)
+                if login in claimed:
+                    # Another school has it; our classes resolve it by login
+                    plan.known_logins[op.key] = login
+                    self.shared_users += 1
+                else:
+                    keep.append(op)
+            plan.user_operations = keep
+            claimed |= ours
+
+    def describe(self):
+        lines = []
+        for school_id, plan in self.plans.items():
+            lines.append("School {}:".format(school_id))
+            lines.append(plan.describe())
+        lines.append("{} users left to the school that has them first".format(self.shared_users))
+        return "\n".join(lines)
+
+    def execute(self):
+        """Execute the plans: users of every school, then classes, then class members."""
+        for plan in self.plans.values():
+            plan.start()
+        try:
+            for phase in ('execute_users', 'execute_classes', 'execute_members'):
+                self._map_schools(lambda school_id: getattr(self.plans[school_id], phase)(
+                    self.controllers[school_id], self.executor))
+                self.controller.run_due_check()
+        finally:
+            for plan in self.plans.values():
+                plan.events.flush()
+        for school_id, plan in self.plans.items():
+            self.importers[school_id].import_done(plan)
+
+    def run(self, dry_run=False, journals=None):
+        """Plan and execute; with dry_run, only print the plans.
+
+            :returns: {school id: SyncPlan}
+
+        """
+        self.plan(journals=journals)
+        if dry_run:
+            print(self.describe())
+        else:
+            self.execute()
+        return self.plans
@@ -0,0 +1,91 @@
+"""Passwords: generating them, and reading (login, password) pairs from CSV."""
+import csv
+import secrets
+import threading
+from collections import namedtuple
+
+password_characters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890"
+
+# What Controller.set_passwords did for a login: status is 'updated', 'missing' or
+# 'failed'; code is the HTTP status and message the start of the response (or the
+# error) when it failed
+PasswordResult = namedtuple('PasswordResult', ('status', 'code', 'message'))
+
+
+class PasswordGenerator(object):
+    """Random passwords from the secrets module, drawn many at a time.
+
+    Random bytes come from the OS in batches and are mapped onto the
+    alphabet with bytes.translate; bytes that would make some characters
+    likelier than others are dropped. Safe to share between threads.
+
+        :param length: characters per password
+        :param alphabet: ASCII characters to use, 2 to 256 of them
+        :param batch: how many passwords' worth of randomness to draw at once
+
+    """
+
+    def __init__(self, length=30, alphabet=password_characters, batch=256):
+        alphabet = alphabet.encode('ascii')
+        if not 2 <= len(alphabet) <= 256:
+            raise ValueError("alphabet has to have 2 to 256 characters")
+        self.length = length
+        self.batch = batch
+        usable = 256 - 256 % len(alphabet)
+        self._table = bytes(alphabet[x % len(alphabet)] for x in range(256))
+        self._rejected = bytes(range(usable, 256))
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+
+    def _take(self, size):
+        with self._lock:
+            while len(self._buffer) < size:
+                raw = secrets.token_bytes(max(size, self.length * self.batch))
+                self._buffer += raw.translate(self._table, self._rejected)
+            chunk = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return chunk.decode('ascii')
+
+    def generate(self, count=None):
+        """One password, or a list of count passwords."""
+        if count is None:
+            return self._take(self.length)
+        chunk = self._take(count * self.length)
+        return [chunk[x:x + self.length] for x in range(0, len(chunk), self.length)]
+
+    __call__ = generate
+
+
+def read_password_csv(source, login_column='login', password_column='password', generator=None, **fmtparams):
+    """Yield (login, password) pairs from a CSV file with a header row.
+
+    Rows without a login are skipped. Rows without a password (or a file
+    without the password column) get one from generator; without a
+    generator, they raise ValueError.
+
+        :param source: file name or text file object
+        :param login_column: header of the column with logins
+        :param password_column: header of the column with passwords
+        :param generator: PasswordGenerator for missing passwords
+        :param fmtparams: passed on to csv.DictReader, e.g. delimiter=';'
+
+    """
+    if isinstance(source, str):
+        with open(source, newline='', encoding='utf-8-sig') as f:
+            yield from read_password_csv(f, login_column, password_column, generator, **fmtparams)
+        return
+    reader = csv.DictReader(source, **fmtparams)
+    columns = (login_column, password_column) if generator is None else (login_column, )
+    for column in columns:
+        if column not in (reader.fieldnames or ()):
+            raise ValueError("No {!r} column in the CSV header".format(column))
+    for row in reader:
+        login = (row[login_column] or '').strip()
+        if not login:
+            continue
+        password = row.get(password_column) or ''
+        if not password:
+            if generator is None:
+                raise ValueError("No password for {} (line {})".format(login, reader.line_num))
+            password = generator.generate()
+        yield login, password
@@ -0,0 +1,321 @@
+import time
+from .Controller import UserExists, ClassExists, OperationalError, PruneThresholdExceeded
+from .Events import EventStream, ImportReport
+
+
+class Operation(object):
+    def __init__(self, kind, key, obj, changes=None, user_keys=None, current=None):
+        self.kind = kind
+        self.key = key
+        self.obj = obj
+        self.changes = changes if changes is not None else []
+        # set_members only: wanted member keys, and user ids currently in the group
+        # (None for a class that's yet to be created)
+        self.user_keys = user_keys if user_keys is not None else []
+        self.current = current
+
+    def __str__(self):
+        if self.kind == 'set_members':
+            return "{}: {} ({} members, {} now)".format(self.key, self.kind, len(self.user_keys),
+                                                        len(self.current) if self.current is not None else 0)
+        if self.changes:
+            return "{}: {} ({})".format(self.key, self.kind, ", ".join(str(x) for x in self.changes))
+        return "{}: {}".format(self.key, self.kind)
+
+    def __repr__(self):
+        return "Operation({!r}, {!r})".format(self.kind, self.key)
+
+
+class SyncPlan(object):
+    """Remote operations needed to bring mob-edu in line with an importer.
+
+    Built by Importer.plan_import. Users and classes which are already up to date
+    don't get an operation at all; print the plan (or describe()) for a dry run,
+    call execute() to actually do it. What execute() does goes to events
+    (see EventStream), and is summed up in report.
+    """
+
+    def __init__(self, journal=None, events=None):
+        self.journal = journal
+        self.events = events if events is not None else EventStream()
+        self.report = ImportReport()
+        self.user_operations = []
+        self.class_operations = []
+        self.member_operations = []
+        # Only what's needed to resolve class members: ids of known users,
+        # logins of the ones that don't exist remotely yet
+        self.user_ids = {}
+        self.pending_logins = {}
+        self.unchanged_users = 0
+        self.unchanged_classes = 0
+        # Skipped because a journal says they're done
+        self.journaled = 0
+        # Keys of classes whose members are already right
+        self.settled_classes = []
+        # Logins of users the importer left out of the plan (e.g. unchanged ones),
+        # so that class members can still be resolved: key -> login
+        self.known_logins = {}
+        # Logins of the users the plan was made for: key -> login
+        self.user_logins = {}
+        # Keys of users and classes whose operations failed
+        self.failed = set()
+
+    @property
+    def operations(self):
+        return self.user_operations + self.class_operations + self.member_operations
+
+    def __len__(self):
+        return len(self.user_operations) + len(self.class_operations) + len(self.member_operations)
+
+    def __str__(self):
+        return self.describe()
+
+    def describe(self):
+        lines = [str(op) for op in self.operations]
+        lines.append("{} operations, {} users and {} classes up to date, {} done before".format(
+            len(self), self.unchanged_users, self.unchanged_classes, self.journaled))
+        return "\n".join(lines)
+
+    def add_user_key(self, controller, user_key, user):
+        login = controller.user_login(user)
+        self.user_logins[user_key] = login
+        if controller.has_login(login):
+            self.user_ids[user_key] = controller.user_for_login(login)['id']
+        else:
+            self.pending_logins[user_key] = login
+
+    def resolve_member_ids(self, controller, user_keys, warn=True):
+        """Map user keys to remote user ids.
+
+            :returns: (ids, unresolved keys)
+
+        """
+        ids = []
+        unresolved = []
+        for user_key in user_keys:
+            if user_key not in self.user_ids and user_key in self.pending_logins \
+                    and controller.has_login(self.pending_logins[user_key]):
+                self.user_ids[user_key] = controller.user_for_login(self.pending_logins.pop(user_key))['id']
+            elif user_key not in self.user_ids and user_key not in self.pending_logins \
+                    and user_key in self.known_logins and controller.has_login(self.known_logins[user_key]):
+                self.user_ids[user_key] = controller.user_for_login(self.known_logins[user_key])['id']
+            if user_key in self.user_ids:
+                ids.append(self.user_ids[user_key])
+                continue
+            unresolved.append(user_key)
+            if warn:
+                self._emit('members', user_key, None, 'missing', message="User not found")
+        return ids, unresolved
+
+    def _record(self, key, op, **data):
+        if self.journal is not None:
+            self.journal.record(key, op, **data)
+
+    def _emit(self, phase, key, action, status, started=None, **data):
+        event = {'time': time.time(), 'phase': phase, 'key': key, 'action': action, 'status': status}
+        if started is not None:
+            event['duration'] = time.monotonic() - started
+        event.update(data)
+        self.report(event)
+        self.events.emit(event)
+
+    def _execute_user(self, controller, op):
+        started = time.monotonic()
+        if op.kind == 'create_user':
+            try:
+                result = controller.create_user(op.obj, teacher=op.obj["is_teacher"], skip_update=True)
+                status = 'created'
+            except UserExists:
+                result = controller.update_user(op.obj)
+                status = 'updated'
+        elif op.kind == 'update_user':
+            result = controller.update_user(op.obj)
+            status = 'updated'
+        elif op.kind == 'activate_user':
+            result = controller.activate_user(op.obj)
+            status = 'activated'
+        else:
+            return
+        self._emit('users', op.key, op.kind, status if result else 'failed', started)
+        if result:
+            self._record(op.key, 'user', id=controller.cached_user_id(controller.user_login(op.obj)))
+        else:
+            self.failed.add(op.key)
+
+    def _execute_class(self, controller, op):
+        started = time.monotonic()
+        if op.kind == 'create_class':
+            try:
+                result = controller.create_class(
+                    op.obj, on_created=lambda obj: self._record(op.key, 'class_created', id=obj['id']))
+                status = 'created'
+            except ClassExists:
+                result = controller.update_class(op.obj)
+                status = 'updated'
+        elif op.kind == 'update_class':
+            result = controller.update_class(op.obj)
+            status = 'updated'
+        elif op.kind == 'repair_class':
+            try:
+                result = controller.repair_class(op.obj)
+            except OperationalError:
+                result = False
+            status = 'repaired'
+        else:
+            return
+        self._emit('classes', op.key, op.kind, status if result else 'failed', started)
+        if result:
+            self._record(op.key, 'class')
+        else:
+            self.failed.add(op.key)
+
+    def execute(self, controller, executor=None):
+        """Run the plan: users first, then classes, then class members.
+
+            :param controller: the Controller the plan was made with
+            :param executor: ImportExecutor to run each phase concurrently; serial if omitted
+
+        """
+        self.start()
+        try:
+            for phase in (self.execute_users, self.execute_classes, self.execute_members):
+                phase(controller, executor)
+                controller.run_due_check()
+        finally:
+            self.events.flush()
+
+    def start(self):
+        """Tell events (and report) how much is coming; execute() does this itself."""
+        self._emit('plan', None, None, 'planned', operations=len(self),
+                   unchanged=self.unchanged_users + self.unchanged_classes, journaled=self.journaled)
+
+    @staticmethod
+    def _runner(executor):
+        if executor is None:
+            return lambda fn, items: [fn(x) for x in items]
+        return executor.map
+
+    def execute_users(self, controller, executor=None):
+        with controller.metrics.phase('users'):
+            type(self)._runner(executor)(lambda op: self._execute_user(controller, op), self.user_operations)
+
+    def execute_classes(self, controller, executor=None):
+        with controller.metrics.phase('classes'):
+            type(self)._runner(executor)(lambda op: self._execute_class(controller, op), self.class_operations)
+
+    def execute_members(self, controller, executor=None):
+        """Set class members; every user has to exist by now, so every member id can be resolved."""
+        with controller.metrics.phase('members'):
+            for key in self.settled_classes:
+                self._record(key, 'members')
+
+            batch = controller.membership_batch()
+            for op in self.member_operations:
+                members, unresolved = self.resolve_member_ids(controller, op.user_keys)
+                if unresolved:
+                    # Not finished with this class until all its members exist
+                    self.failed.add(op.key)
+                if op.current is not None and set(members) == set(op.current):
+                    # Whatever was missing at planning time is still missing
+                    self._emit('members', op.key, op.kind, 'unchanged', time.monotonic())
+                    if op.key not in self.failed:
+                        self._record(op.key, 'members')
+                    continue
+                batch.set(op.obj, members, key=op.key)
+            for key, changed in batch.flush(executor).items():
+                self._emit('members', key, 'set_members', 'updated' if changed else 'unchanged',
+                           duration=batch.durations.get(key, 0.0))
+                if key not in self.failed:
+                    # Classes missing members (or whose class operation failed) are
+                    # left out of the journal, so that a resumed run sets them again
+                    self._record(key, 'members')
+            for key, error in batch.errors.items():
+                self._emit('members', key, 'set_members', 'failed',
+                           duration=batch.durations.get(key, 0.0), message=str(error) or None)
+                self.failed.add(key)
+
+
+class PrunePlan(object):
+    """Remote users and classes that aren't in the importer any more.
+
+    Built by Importer.plan_prune; operations are 'delete_user',
+    'deactivate_user' and 'delete_class', keyed by login or class name.
+    """
+
+    def __init__(self, remote_users=0, remote_classes=0, events=None):
+        self.events = events if events is not None else EventStream()
+        self.report = ImportReport()
+        self.user_operations = []
+        self.class_operations = []
+        # How many users and classes of the school there are remotely, for the threshold
+        self.remote_users = remote_users
+        self.remote_classes = remote_classes
+        self.failed = set()
+
+    @property
+    def operations(self):
+        return self.user_operations + self.class_operations
+
+    def __len__(self):
+        return len(self.user_operations) + len(self.class_operations)
+
+    def __str__(self):
+        return self.describe()
+
+    def describe(self):
+        lines = [str(op) for op in self.operations]
+        lines.append("{} of {} users and {} of {} classes to remove".format(
+            len(self.user_operations), self.remote_users, len(self.class_operations), self.remote_classes))
+        return "\n".join(lines)
+
+    def check_threshold(self, max_fraction):
+        """Raise PruneThresholdExceeded if more than max_fraction of users or classes would go."""
+        for count, total, what in ((len(self.user_operations), self.remote_users, 'users'),
+                                   (len(self.class_operations), self.remote_classes, 'classes')):
+            if total and count > max_fraction * total:
+                raise PruneThresholdExceeded("Would remove {} of {} {}, more than {:.0%}".format(
+                    count, total, what, max_fraction))
+
+    _emit = SyncPlan._emit
+
+    def _execute(self, controller, op):
+        started = time.monotonic()
+        try:
+            if op.kind == 'delete_user':
+                result = controller.delete_remote_user(op.obj)
+            elif op.kind == 'deactivate_user':
+                result = controller.deactivate_remote_user(op.obj)
+            elif op.kind == 'delete_class':
+                result = controller.delete_remote_class(op.obj)
+            else:
+                return
+        except OperationalError:
+            result = False
+        status = {'delete_user': 'deleted', 'deactivate_user': 'deactivated', 'delete_class': 'deleted'}[op.kind]
+        self._emit('prune', op.key, op.kind, status if result else 'failed', started)
+        if not result:
+            self.failed.add(op.key)
+
+    def execute(self, controller, executor=None, refresh=False):
+        """Remove everything in the plan.
+
+            :param executor: ImportExecutor to send the requests concurrently
+            :param refresh: refetch the lists once at the end; the cache is kept
+                            up to date as things are removed anyway
+
+        """
+        if executor is None:
+            run = lambda fn, items: [fn(x) for x in items]
+        else:
+            run = executor.map
+        self._emit('plan', None, None, 'planned', operations=len(self), unchanged=0, journaled=0)
+        try:
+            with controller.metrics.phase('prune'):
+                run(lambda op: self._execute(controller, op), self.user_operations)
+                run(lambda op: self._execute(controller, op), self.class_operations)
+                if refresh:
+                    controller.refresh()
+                else:
+                    controller.run_due_check()
+        finally:
+            self.events.flush()
@@ -0,0 +1,158 @@
+import hashlib
+import json
+
+_MISSING = object()
+
+# Equal tuples are shared between records: there are only a few role sets
+# and a few combinations of fields listed
+_interned = {}
+
+
+def _intern(value):
+    return _interned.setdefault(value, value)
+
+
+class UserRecord(object):
+    """The part of a listed user the controller keeps in memory.
+
+    A full user from the listing has a few dozen fields, the controller looks
+    at just id, login, active/activated, roles and schoolId. A record keeps
+    those, plus a 32-bit digest of each field diff_user compares, so that
+    changes can still be told apart without keeping (or fetching) the rest.
+    Full users are fetched on demand with Controller._get_user_detail.
+
+    Records can be read like the dicts they replace (record['id'],
+    'roles' in record, record.get('active')); fields they don't keep are
+    simply not there.
+    """
+
+    __slots__ = ('id', 'login', 'active', 'activated', 'roles', 'schoolId', 'digest', 'digest_fields')
+
+    fields = ('id', 'login', 'active', 'activated', 'roles', 'schoolId')
+    digest_bits = 32
+
+    def __init__(self, entry, diff_fields=()):
+        """
+            :param entry: user dict from the listing, or from a snapshot of records
+            :param diff_fields: fields to keep digests of
+
+        """
+        for name in type(self).fields:
+            value = entry.get(name, _MISSING)
+            if value is not _MISSING:
+                setattr(self, name, _intern(tuple(value)) if name == 'roles' and value is not None else value)
+        if '_digest' in entry:
+            self.digest_fields = _intern(tuple(entry['_digest_fields']))
+            self.digest = entry['_digest']
+        else:
+            self.digest_fields = _intern(tuple(x for x in diff_fields if x in entry))
+            self.digest = type(self).digest_of(entry, self.digest_fields)
+
+    @classmethod
+    def field_digest(cls, value):
+        data = json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return int.from_bytes(hashlib.blake2b(data, digest_size=cls.digest_bits // 8).digest(), 'big')
+
+    @classmethod
+    def digest_of(cls, entry, fields):
+        """Digests of fields of entry, packed into one int."""
+        digest = 0
+        for name in fields:
+            digest = (digest << cls.digest_bits) | cls.field_digest(entry[name])
+        return digest
+
+    def _field_digest_at(self, n):
+        shift = (len(self.digest_fields) - 1 - n) * type(self).digest_bits
+        return (self.digest >> shift) & ((1 << type(self).digest_bits) - 1)
+
+    def changed_fields(self, obj, fields):
+        """Fields of obj (out of fields) that differ from what the listing had.
+
+        Like comparing with the full user, fields that either side lacks don't count.
+        """
+        changed = []
+        for name in fields:
+            if name not in obj:
+                continue
+            value = getattr(self, name, _MISSING) if name in type(self).fields else _MISSING
+            if value is not _MISSING:
+                if name == 'roles' and value is not None:
+                    value = list(value)
+                if obj[name] != value:
+                    changed.append(name)
+            elif name in self.digest_fields:
+                if type(self).field_digest(obj[name]) != self._field_digest_at(self.digest_fields.index(name)):
+                    changed.append(name)
+        return changed
+
+    def update_from(self, obj):
+        """Take over the fields of obj that the record keeps; id and login never change."""
+        for name in type(self).fields:
+            if name in obj and name not in ('id', 'login'):
+                setattr(self, name, _intern(tuple(obj[name])) if name == 'roles' and obj[name] is not None
+                        else obj[name])
+        if any(x in obj for x in self.digest_fields):
+            digest = 0
+            for n, name in enumerate(self.digest_fields):
+                part = type(self).field_digest(obj[name]) if name in obj else self._field_digest_at(n)
+                digest = (digest << type(self).digest_bits) | part
+            self.digest = digest
+
+    def to_dict(self):
+        """Plain dict with everything needed to rebuild the record, for snapshots."""
+        entry = dict(self.items())
+        entry['_digest'] = self.digest
+        entry['_digest_fields'] = list(self.digest_fields)
+        return entry
+
+    def __getitem__(self, name):
+        value = getattr(self, name, _MISSING) if name in type(self).fields else _MISSING
+        if value is _MISSING:
+            raise KeyError(name)
+        if name == 'roles' and value is not None:
+            # Callers get the list they would have got from the listing
+            return list(value)
+        return value
+
+    def __setitem__(self, name, value):
+        if name not in type(self).fields:
+            raise KeyError(name)
+        self.update_from({name: value})
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in type(self).fields and hasattr(self, name)
+
+    def keys(self):
+        return [x for x in type(self).fields if hasattr(self, x)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, UserRecord):
+            return self.items() == other.items() and self.digest_fields == other.digest_fields \
+                and self.digest == other.digest
+        if isinstance(other, dict):
+            return self == UserRecord(other, self.digest_fields)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "UserRecord({!r})".format(dict(self.items()))
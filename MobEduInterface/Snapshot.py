@@ -0,0 +1,42 @@
+import gzip
+import json
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path, state):
+    """Write a snapshot dict as gzipped compact json.
+
+    The file is created readable by the owner only, it may contain a session cookie.
+    """
+    tmp_path = "{}.tmp".format(path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # GzipFile doesn't close a file object it's given, so both are closed here;
+    # the data is on disk before the snapshot replaces the old one
+    with os.fdopen(fd, 'wb') as raw:
+        with gzip.open(raw, 'wt', encoding='utf-8') as f:
+            json.dump(dict(state, version=SNAPSHOT_VERSION, saved_at=time.time()), f, separators=(',', ':'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path, max_age=None):
+    """Read a snapshot written by write_snapshot.
+
+        :param max_age: seconds; older snapshots are ignored
+        :returns: snapshot dict, or None if there's no usable snapshot
+
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, EOFError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get('version') != SNAPSHOT_VERSION:
+        return None
+    if max_age is not None and time.time() - state.get('saved_at', 0) > max_age:
+        return None
+    return state
@@ -0,0 +1,238 @@
+"""Sync an LDAP directory into mob-edu.
+
+    python -m MobEduInterface --config sync.json
+    python -m MobEduInterface --url https://edu.mob-edu.ru --username admin \\
+        --ldap-url ldaps://ldap.example.com --ldap-user cn=reader,o=school \\
+        --base ou=people,o=school --base ou=classes,o=school \\
+        --teacher-attribute employeeType --teacher-value teacher --dry-run
+
+Passwords are read from the MOBEDU_PASSWORD and LDAP_PASSWORD environment
+variables (or --password-env / --ldap-password-env) rather than the command
+line. --config takes a JSON object with the same names as the long options,
+dashes as underscores (e.g. {"url": ..., "base": [...], "workers": 16});
+options given on the command line win.
+
+--stats prints requests, errors and latency per endpoint and the time spent
+in each phase; --profile runs the sync under cProfile.
+"""
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+
+import ldap3
+
+from .Changes import ChangeTracker
+from .Controller import Controller, PruneThresholdExceeded
+from .Events import ConsoleSink, EventStream, JsonLinesSink
+from .Executor import AdaptiveLimiter, ImportExecutor
+from .Import import LdapImporter
+from .Journal import ImportJournal
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m MobEduInterface', description=__doc__.splitlines()[0],
+                                     epilog="\n".join(__doc__.splitlines()[1:]),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help="JSON file with defaults for any of the options below")
+
+    group = parser.add_argument_group("mob-edu")
+    group.add_argument('--url', help="base url of the mob-edu instance")
+    group.add_argument('--username')
+    group.add_argument('--password-env', default='MOBEDU_PASSWORD',
+                       help="environment variable holding the password (default: %(default)s)")
+    group.add_argument('--school', type=int, help="school id, if the account manages several")
+    group.add_argument('--cookie', help="file to keep the session cookie in between runs")
+
+    group = parser.add_argument_group("LDAP")
+    group.add_argument('--ldap-url')
+    group.add_argument('--ldap-user', help="bind DN")
+    group.add_argument('--ldap-password-env', default='LDAP_PASSWORD',
+                       help="environment variable holding the bind password (default: %(default)s)")
+    group.add_argument('--base', action='append', help="search base; may be given several times")
+    group.add_argument('--user-filter', default="(objectClass=inetOrgPerson)")
+    group.add_argument('--class-filter', default="(objectClass=groupOfNames)")
+    group.add_argument('--teacher-attribute', help="users with this attribute set are teachers")
+    group.add_argument('--teacher-value', help="... set to this value, if given")
+    group.add_argument('--all-attributes', action='store_true',
+                       help="fetch every attribute instead of only the mapped ones")
+
+    group = parser.add_argument_group("tuning")
+    group.add_argument('--workers', type=int, default=8, help="operations run at once (default: %(default)s)")
+    group.add_argument('--adaptive', action='store_true',
+                       help="let an AdaptiveLimiter bring concurrency down when the server struggles")
+    group.add_argument('--page-concurrency', type=int, help="mob-edu list pages fetched at once")
+    group.add_argument('--ldap-page-size', type=int, default=500,
+                       help="LDAP paged search size, 0 for unpaged (default: %(default)s)")
+    group.add_argument('--timeout', type=float, help="request timeout, seconds")
+    group.add_argument('--compact-users', action='store_true', help="keep less of every remote user in memory")
+
+    group = parser.add_argument_group("mode")
+    group.add_argument('--dry-run', action='store_true', help="print what would be done and stop")
+    group.add_argument('--journal', help="file recording finished operations, to resume an interrupted run")
+    group.add_argument('--resume', action='store_true', help="continue the run recorded in --journal")
+    group.add_argument('--incremental', metavar='STATE',
+                       help="file remembering what LDAP looked like; only changed entries are synced")
+    group.add_argument('--timestamp-attribute',
+                       help="with --incremental, e.g. modifyTimestamp, to have LDAP skip old entries")
+    group.add_argument('--full', action='store_true', help="with --incremental, sync everything this time")
+    group.add_argument('--prune', choices=('deactivate', 'delete'),
+                       help="afterwards, deactivate or delete remote users and classes LDAP doesn't have")
+    group.add_argument('--max-prune-fraction', type=float, default=0.1,
+                       help="refuse to prune more than this share (default: %(default)s)")
+    group.add_argument('--force-prune', action='store_true', help="prune whatever --max-prune-fraction says")
+
+    group = parser.add_argument_group("output")
+    group.add_argument('--events', choices=('console', 'json', 'quiet'), default='console',
+                       help="one line per operation, as text or JSON, or nothing (default: %(default)s)")
+    group.add_argument('--events-file', help="write events there instead of stdout")
+    group.add_argument('--stats', action='store_true', help="print requests and latency per endpoint at the end")
+    group.add_argument('--stats-json', help="write the request metrics to this file as JSON")
+    group.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                       help="run under cProfile; print the top functions, or save pstats data to FILE")
+    group.add_argument('--profile-limit', type=int, default=30, help="functions printed by --profile")
+    group.add_argument('-v', '--verbose', action='count', default=0)
+    return parser
+
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config = json.load(f)
+        known = {action.dest for action in parser._actions}
+        unknown = set(config) - known
+        if unknown:
+            parser.error("unknown settings in {}: {}".format(args.config, ", ".join(sorted(unknown))))
+        if args.base is not None:
+            # --base appends to its default; bases on the command line replace the config's
+            config.pop('base', None)
+        elif isinstance(config.get('base'), str):
+            config['base'] = [config['base']]
+        parser.set_defaults(**config)
+    args = parser.parse_args(argv)
+    for name in ('url', 'username', 'ldap_url', 'base'):
+        if not getattr(args, name):
+            parser.error("--{} is required".format(name.replace('_', '-')))
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+    if (args.full or args.timestamp_attribute) and not args.incremental:
+        parser.error("--full and --timestamp-attribute need --incremental")
+    return args
+
+
+def make_events(args):
+    if args.events == 'quiet':
+        return EventStream([])
+    if args.events == 'json':
+        return EventStream([JsonLinesSink(args.events_file or sys.stdout)])
+    return EventStream([ConsoleSink(args.events_file)])
+
+
+def make_importer(args):
+    server = ldap3.Server(args.ldap_url, get_info=ldap3.SCHEMA)
+    connection = ldap3.Connection(server, user=args.ldap_user, password=os.environ.get(args.ldap_password_env),
+                                  auto_bind=True, read_only=True)
+    check_if_teacher = None
+    if args.teacher_attribute:
+        def check_if_teacher(entry, attribute=args.teacher_attribute, value=args.teacher_value):
+            # Users without the attribute are students, not an error
+            values = entry['attributes'].get(attribute)
+            values = [x for x in (values if isinstance(values, list) else [values]) if x not in (None, '')]
+            return bool(values) if value is None else value in values
+    tracker = None
+    if args.incremental:
+        tracker = ChangeTracker(args.incremental, timestamp_attribute=args.timestamp_attribute, full=args.full)
+    return LdapImporter(connection, args.base,
+                        check_if_teacher=check_if_teacher,
+                        user_filter=args.user_filter,
+                        class_filter=args.class_filter,
+                        page_size=args.ldap_page_size or None,
+                        project_attributes=not args.all_attributes,
+                        extra_user_attributes=[args.teacher_attribute] if args.teacher_attribute else (),
+                        change_tracker=tracker)
+
+
+def sync(args, controller, importer, events):
+    """Run the sync; returns the exit status."""
+    executor = ImportExecutor(args.workers)
+    journal = ImportJournal(args.journal) if args.journal else None
+    try:
+        plan = importer.do_import(controller, dry_run=args.dry_run, executor=executor, journal=journal,
+                                  resume=args.resume, events=events)
+    finally:
+        if journal is not None:
+            journal.close()
+    status = 0
+    if not args.dry_run:
+        print(plan.report, file=sys.stderr)
+        status = 1 if plan.failed else 0
+
+    if args.prune:
+        try:
+            prune = importer.do_prune(controller, dry_run=args.dry_run, action=args.prune,
+                                      max_fraction=args.max_prune_fraction, force=args.force_prune,
+                                      executor=executor, events=events)
+        except PruneThresholdExceeded as e:
+            print("Not pruning: {}".format(e), file=sys.stderr)
+            return 1
+        if not args.dry_run:
+            print(prune.report, file=sys.stderr)
+            status = status or (1 if prune.failed else 0)
+    return status
+
+
+def run(args):
+    limiter = AdaptiveLimiter(max_concurrency=args.workers) if args.adaptive else None
+    controller = Controller(args.url, pool_size=max(args.workers, args.page_concurrency or 0, 10),
+                            timeout=args.timeout, page_concurrency=args.page_concurrency,
+                            rate_limiter=limiter, compact_users=args.compact_users)
+    events = make_events(args)
+    try:
+        if not controller.login(args.username, os.environ.get(args.password_env, ''), cookie_path=args.cookie):
+            print("Can't log in to {} as {}".format(args.url, args.username), file=sys.stderr)
+            return 1
+        if args.school is not None:
+            if args.school not in controller.managed_school_list:
+                print("School {} isn't managed by {}".format(args.school, args.username), file=sys.stderr)
+                return 1
+            controller.set_managed_school(args.school)
+        elif controller.managed_school is None:
+            print("{} manages several schools, pick one with --school: {}".format(
+                args.username, ", ".join(str(x) for x in controller.managed_school_list)), file=sys.stderr)
+            return 1
+        return sync(args, controller, make_importer(args), events)
+    finally:
+        events.close()
+        controller.close()
+        if args.stats:
+            print(controller.metrics.summary(), file=sys.stderr)
+        if args.stats_json:
+            with open(args.stats_json, 'w', encoding='utf-8') as f:
+                f.write(controller.metrics.to_json(indent=2))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING - 10 * args.verbose, format="%(asctime)s %(name)s %(message)s")
+    if not args.profile:
+        return run(args)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(run, args)
+    finally:
+        if args.profile == '-':
+            stats = pstats.Stats(profile, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(args.profile_limit)
+        else:
+            profile.dump_stats(args.profile)
+            print("Profile saved to {}, see python -m pstats".format(args.profile), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
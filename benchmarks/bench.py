@@ -0,0 +1,207 @@
+"""Sync benchmarks against the local mock server.
+
+For every size, an ldap3 MOCK_SYNC directory with that many users (and a class
+per class_size of them) is imported into an empty mock mob-edu with
+LdapImporter.do_import, then imported again with nothing to change.
+Each step runs in a process of its own and reports requests sent, wall time
+and how much the peak RSS grew beyond the directory itself.
+
+    python benchmarks/bench.py                          # 1k, 10k and 50k users
+    python benchmarks/bench.py --sizes 1000 --latency 0.002 --workers 16
+    python benchmarks/bench.py --json current.json --baseline previous.json
+
+With --baseline, steps that got slower, heavier or chattier than the
+baseline by more than --tolerance are reported and the exit status is 1.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import ldap3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MobEduInterface.Controller import Controller
+from MobEduInterface.Events import EventStream
+from MobEduInterface.Executor import AdaptiveLimiter, ImportExecutor
+from MobEduInterface.Import import LdapImporter
+
+from mock_server import MockServer
+
+USERS_BASE = 'ou=users,o=bench'
+CLASSES_BASE = 'ou=classes,o=bench'
+CREDENTIALS = ('admin', 'admin')
+
+
+def make_directory(n_users, class_size=25, teacher_every=20):
+    """ldap3 MOCK_SYNC connection holding n_users users and their classes."""
+    server = ldap3.Server('mock')
+    connection = ldap3.Connection(server, user='cn=admin,o=bench', password='admin',
+                                  client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry('cn=admin,o=bench', {'userPassword': 'admin', 'sn': 'admin'})
+    for i in range(n_users):
+        connection.strategy.add_entry('cn=u{},{}'.format(i, USERS_BASE), {
+            'objectClass': ['inetOrgPerson'],
+            'cn': 'u{}'.format(i),
+            'givenName': 'Given{}'.format(i % 97),
+            'sn': 'Surname{}'.format(i),
+            'cms-email': 'u{}@example.com'.format(i),
+            'employeeType': 'teacher' if i % teacher_every == 0 else 'student',
+        })
+    for n, start in enumerate(range(0, n_users, class_size)):
+        # parallel 1..11, letters made unique per parallel
+        connection.strategy.add_entry('cn=c{},{}'.format(n, CLASSES_BASE), {
+            'objectClass': ['groupOfNames'],
+            'cn': 'c{}'.format(n),
+            'eline-division-name': '{} L{} class'.format(n % 11 + 1, n // 11),
+            'member': ['cn=u{},{}'.format(i, USERS_BASE) for i in range(start, min(start + class_size, n_users))],
+        })
+    connection.bind()
+    return connection
+
+
+def is_teacher(entry):
+    return entry['attributes'].get('employeeType') in ('teacher', ['teacher'])
+
+
+def _serve(queue, latency, jitter, error_rate):
+    server = MockServer(latency=latency, jitter=jitter, error_rate=error_rate, credentials=CREDENTIALS, seed=0)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+@contextlib.contextmanager
+def mock_server_process(latency=0.0, jitter=0.0, error_rate=0.0):
+    """Run a MockServer in a child process, so it doesn't compete with the client for the GIL."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(queue, latency, jitter, error_rate), daemon=True)
+    process.start()
+    try:
+        yield queue.get(timeout=30)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def _maxrss_mb():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_step(url, n_users, args, step):
+    """One import, in a fresh process so that its peak memory is its own."""
+    directory = make_directory(n_users, class_size=args.class_size)
+    importer = LdapImporter(directory, [USERS_BASE, CLASSES_BASE],
+                            check_if_teacher=is_teacher,
+                            page_size=args.ldap_page_size,
+                            project_attributes=True,
+                            extra_user_attributes=['employeeType'])
+    result = {'users': n_users, 'step': step}
+    rss_before = _maxrss_mb()
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+
+    limiter = AdaptiveLimiter(max_concurrency=args.workers) if args.adaptive else None
+    controller = Controller(url, pool_size=args.workers, page_concurrency=args.page_concurrency,
+                            rate_limiter=limiter, compact_users=args.compact_users)
+    if not controller.authenticate(*CREDENTIALS):
+        raise RuntimeError("Can't authenticate against the mock server")
+    plan = None
+    try:
+        plan = importer.do_import(controller, executor=ImportExecutor(args.workers), events=EventStream([]))
+    except Exception as e:
+        # Still worth reporting, e.g. with --error-rate a failed POST ends the import
+        result['error'] = repr(e)
+
+    result['wall'] = time.perf_counter() - started
+    # Growth of the peak RSS over what the directory took
+    result['peak_mb'] = _maxrss_mb() - rss_before
+    if args.tracemalloc:
+        result['traced_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    result['requests'] = controller.metrics.total_requests
+    result['operations'] = len(plan) if plan is not None else None
+    result['phases'] = controller.metrics.stats()['phases']
+    controller.close()
+    return result
+
+
+def run_size(n_users, args):
+    """Import n_users into an empty server, then again with nothing to change."""
+    results = []
+    with mock_server_process(args.latency, args.jitter, args.error_rate) as url:
+        for step in ('initial', 'rerun'):
+            with multiprocessing.Pool(1) as pool:
+                results.append(pool.apply(run_step, (url, n_users, args, step)))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Lines about results worse than baseline by more than tolerance (a fraction)."""
+    previous = {(x['users'], x['step']): x for x in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['users'], result['step']))
+        if old is None:
+            continue
+        for metric in ('wall', 'requests', 'peak_mb'):
+            if metric in result and old.get(metric) and result[metric] > old[metric] * (1 + tolerance):
+                regressions.append("{} users, {}: {} {:.2f} -> {:.2f}".format(
+                    result['users'], result['step'], metric, old[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LdapImporter.do_import against a mock mob-edu")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help="numbers of users")
+    parser.add_argument('--class-size', type=int, default=25)
+    parser.add_argument('--workers', type=int, default=8, help="import executor threads")
+    parser.add_argument('--page-concurrency', type=int, default=None)
+    parser.add_argument('--ldap-page-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0, help="mock server latency, seconds")
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--adaptive', action='store_true',
+                        help="use an AdaptiveLimiter, which also retries failed requests")
+    parser.add_argument('--compact-users', action='store_true', help="keep users as UserRecords")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="also report the peak of traced allocations; slows the client down a lot")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    print("{:>7} {:<8} {:>9} {:>8} {:>10} {:>9} {:>10}".format(
+        'users', 'step', 'requests', 'ops', 'wall s', 'peak MB', 'traced MB'))
+    for n_users in args.sizes:
+        for result in run_size(n_users, args):
+            results.append(result)
+            print("{users:>7} {step:<8} {requests:>9} {operations:>8} {wall:>10.2f} {peak_mb:>9.1f} {traced:>10}{error}".format(
+                operations='-' if result['operations'] is None else result['operations'],
+                traced='{:.1f}'.format(result['traced_mb']) if 'traced_mb' in result else '-',
+                error='  ' + result['error'] if 'error' in result else '',
+                **{k: v for k, v in result.items() if k not in ('operations', 'error')}))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
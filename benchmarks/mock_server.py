@@ -0,0 +1,451 @@
+"""Local stand-in for a mob-edu instance, for benchmarks and experiments.
+
+Copies the behaviour Controller has to cope with (see Known_mobedu_bugs.md):
+
+- /api/authenticate answers with a `Cookie` header instead of Set-Cookie,
+  holding a new session each time; sessions can be made to expire
+- list pages hold at most 100 objects, whatever per_page says
+- POSTing a user with an existing login gives 409
+- POSTing a class that already exists gives 400 with an `Error_code: 2500` header
+- a class gets its userGroup only when a group is POSTed with its learningClassId
+- middleName is never stored
+- a teacher can't be made a student (400, WRONG_PERSON_ROLES)
+
+Details are served with an ETag and answer If-None-Match with 304.
+Latency and failures can be injected. Run standalone with
+
+    python benchmarks/mock_server.py --port 8080 --latency 0.005 --error-rate 0.01
+
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+MAX_PAGE_SIZE = 100
+SESSION_COOKIE = 'SESSION'
+TEACHER_ROLES = ['ROLE_TEACHER']
+
+
+class MockState(object):
+    """Everything the server knows. Guarded by lock, ids are never reused."""
+
+    def __init__(self, schools=None, admin_schools=None):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.classes = {}
+        self.groups = {}
+        self.versions = Counter()
+        self.schools = schools if schools is not None else [{'id': 1, 'name': 'School 45'}]
+        self.admin_schools = admin_schools if admin_schools is not None else [x['id'] for x in self.schools]
+        self.requests = Counter()
+        self._next_id = 0
+        self._logins = set()
+        self._sorted = {}
+
+    def next_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def changed(self, kind, obj_id=None):
+        self._sorted.pop(kind, None)
+        if obj_id is not None:
+            self.versions[(kind, obj_id)] += 1
+
+    def sorted(self, kind):
+        # Ids only grow, so insertion order is id order; kept until the next change
+        if kind not in self._sorted:
+            self._sorted[kind] = list(getattr(self, kind).values())
+        return self._sorted[kind]
+
+    def add_user(self, obj):
+        obj = dict(obj)
+        obj.pop('middleName', None)
+        obj['id'] = self.next_id()
+        obj.setdefault('active', True)
+        obj['activated'] = obj['active']
+        self.users[obj['id']] = obj
+        self._logins.add(obj['login'])
+        self.changed('users', obj['id'])
+        return obj
+
+    def remove_user(self, user_id):
+        obj = self.users.pop(user_id, None)
+        if obj is None:
+            return None
+        self._logins.discard(obj['login'])
+        for group in self.groups.values():
+            if user_id in group['userIds']:
+                group['userIds'] = [x for x in group['userIds'] if x != user_id]
+                self.changed('groups', group['id'])
+        self.changed('users')
+        return obj
+
+    def has_login(self, login):
+        return login in self._logins
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, every
+    # keep-alive response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    routes = (
+        ('POST', r'/api/authenticate$', 'authenticate'),
+        ('GET', r'/api/account$', 'account'),
+        ('GET', r'/adm/schools$', 'schools'),
+        ('GET', r'/adm/users$', 'users_page'),
+        ('POST', r'/adm/users$', 'user_create'),
+        ('PUT', r'/adm/users$', 'user_update'),
+        ('PUT', r'/adm/users/activate$', 'user_activate'),
+        ('GET', r'/adm/users/(\d+)$', 'user_detail'),
+        ('DELETE', r'/adm/users/(\d+)$', 'user_delete'),
+        ('GET', r'/adm/classes$', 'classes_page'),
+        ('POST', r'/api/learningClasses$', 'class_create'),
+        ('PUT', r'/api/learningClasses$', 'class_update'),
+        ('GET', r'/api/learningClasses/(\d+)$', 'class_detail'),
+        ('DELETE', r'/api/learningClasses/(\d+)$', 'class_delete'),
+        ('POST', r'/api/userGroups$', 'group_create'),
+        ('PUT', r'/api/userGroups$', 'group_update'),
+        ('GET', r'/api/userGroups/(\d+)$', 'group_detail'),
+        ('DELETE', r'/api/userGroups/(\d+)$', 'group_delete'),
+    )
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, obj=None, headers=()):
+        data = json.dumps(obj, separators=(',', ':')).encode('utf-8') if obj is not None else b''
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _detail(self, kind, obj, strip=()):
+        if obj is None:
+            return 404, {}
+        etag = '"{}-{}"'.format(obj['id'], self.server.state.versions[(kind, obj['id'])])
+        if self.headers.get('If-None-Match') == etag:
+            return 304, None, [('ETag', etag)]
+        # A copy: it's serialized after the lock is released
+        return 200, {k: v for k, v in obj.items() if k not in strip}, [('ETag', etag)]
+
+    def _page(self, kind, query, strip=()):
+        page = int(query.get('page', ['1'])[0])
+        per_page = min(MAX_PAGE_SIZE, int(query.get('per_page', [MAX_PAGE_SIZE])[0]))
+        objects = self.server.state.sorted(kind)[(page - 1) * per_page:page * per_page]
+        return 200, [{k: v for k, v in x.items() if k not in strip} for x in objects]
+
+    def _route(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        # Always read the body, or the next request on this connection gets it
+        raw = self.rfile.read(length) if length else b''
+        url = urlparse(self.path)
+        for route_method, pattern, name in type(self).routes:
+            match = re.match(pattern, url.path) if route_method == method else None
+            if match:
+                break
+        else:
+            name, match = 'unknown', None
+
+        server.delay()
+        with server.state.lock:
+            server.state.requests[name] += 1
+        if name != 'authenticate' and server.should_fail():
+            return self._reply(server.error_status, {})
+        if match is None:
+            return self._reply(404, {})
+        if name != 'authenticate' and not server.valid_session(self.headers.get('Cookie')):
+            return self._reply(401, {})
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            return self._reply(400, {})
+        with server.state.lock:
+            reply = getattr(self, 'on_' + name)(body, parse_qs(url.query), *match.groups())
+        return self._reply(*reply)
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    # Endpoints, called with the state lock held. They return status, body[, headers]
+
+    def on_authenticate(self, body, query):
+        if body is None or (body.get('username'), body.get('password')) != self.server.credentials:
+            return 401, {}
+        # Not Set-Cookie, see Known_mobedu_bugs.md
+        return 200, {}, [('Cookie', '{}={}'.format(SESSION_COOKIE, self.server.new_session()))]
+
+    def on_account(self, body, query):
+        state = self.server.state
+        return 200, {
+            'login': self.server.credentials[0],
+            'additionalUserInfoDTO': {'adminSchools': [{'id': x} for x in state.admin_schools]},
+        }
+
+    def on_schools(self, body, query):
+        return 200, self.server.state.schools
+
+    def on_users_page(self, body, query):
+        return self._page('users', query, strip=('password', ))
+
+    def on_user_create(self, body, query):
+        state = self.server.state
+        if state.has_login(body['login']):
+            return 409, {}
+        return 200, {k: v for k, v in state.add_user(body).items() if k != 'password'}
+
+    def on_user_update(self, body, query):
+        state = self.server.state
+        obj = state.users.get(body.get('id'))
+        if obj is None:
+            return 404, {}
+        if obj.get('roles') == TEACHER_ROLES and body.get('roles', TEACHER_ROLES) != TEACHER_ROLES:
+            return 400, {'message': 'WRONG_PERSON_ROLES'}
+        body = dict(body)
+        body.pop('middleName', None)
+        body.pop('login', None)
+        obj.update(body)
+        state.changed('users', obj['id'])
+        return 200, dict(obj)
+
+    def on_user_activate(self, body, query):
+        state = self.server.state
+        obj = state.users.get(body.get('id'))
+        if obj is None:
+            return 404, {}
+        obj['active'] = obj['activated'] = bool(body.get('activate'))
+        state.changed('users', obj['id'])
+        return 200, None
+
+    def on_user_detail(self, body, query, user_id):
+        return self._detail('users', self.server.state.users.get(int(user_id)), strip=('password', ))
+
+    def on_user_delete(self, body, query, user_id):
+        if self.server.state.remove_user(int(user_id)) is None:
+            return 404, {}
+        return 200, None
+
+    def on_classes_page(self, body, query):
+        return self._page('classes', query)
+
+    def on_class_create(self, body, query):
+        state = self.server.state
+        school = (body.get('school') or {}).get('id')
+        for obj in state.classes.values():
+            if obj.get('parallel') == body.get('parallel') and obj.get('letter') == body.get('letter') \
+                    and (obj.get('school') or {}).get('id') == school:
+                return 400, {}, [('Error_code', '2500')]
+        obj = dict(body)
+        obj['id'] = state.next_id()
+        obj['schoolName'] = (obj.get('school') or {}).get('name')
+        obj['userGroup'] = None
+        state.classes[obj['id']] = obj
+        state.changed('classes', obj['id'])
+        return 200, dict(obj)
+
+    def on_class_update(self, body, query):
+        state = self.server.state
+        obj = state.classes.get(body.get('id'))
+        if obj is None:
+            return 404, {}
+        obj.update(body)
+        state.changed('classes', obj['id'])
+        return 200, dict(obj)
+
+    def on_class_detail(self, body, query, class_id):
+        return self._detail('classes', self.server.state.classes.get(int(class_id)))
+
+    def on_class_delete(self, body, query, class_id):
+        state = self.server.state
+        if state.classes.pop(int(class_id), None) is None:
+            return 404, {}
+        state.changed('classes')
+        return 200, None
+
+    def on_group_create(self, body, query):
+        state = self.server.state
+        e_class = state.classes.get(body.get('learningClassId'))
+        if e_class is None:
+            return 400, {}
+        obj = {
+            'id': state.next_id(),
+            'name': body.get('name'),
+            'tutorId': body.get('tutorId'),
+            'userIds': list(body.get('userIds') or []),
+            'learningClasses': [{'id': e_class['id']}],
+        }
+        state.groups[obj['id']] = obj
+        state.changed('groups', obj['id'])
+        e_class['userGroup'] = {'id': obj['id']}
+        state.changed('classes', e_class['id'])
+        return 200, dict(obj)
+
+    def on_group_update(self, body, query):
+        state = self.server.state
+        obj = state.groups.get(body.get('id'))
+        if obj is None:
+            return 404, {}
+        for attr in ('name', 'tutorId', 'userIds'):
+            if attr in body:
+                obj[attr] = body[attr]
+        state.changed('groups', obj['id'])
+        return 200, dict(obj)
+
+    def on_group_detail(self, body, query, group_id):
+        return self._detail('groups', self.server.state.groups.get(int(group_id)))
+
+    def on_group_delete(self, body, query, group_id):
+        state = self.server.state
+        obj = state.groups.pop(int(group_id), None)
+        if obj is None:
+            return 404, {}
+        for e_class in state.classes.values():
+            if (e_class.get('userGroup') or {}).get('id') == obj['id']:
+                e_class['userGroup'] = None
+                state.changed('classes', e_class['id'])
+        state.changed('groups')
+        return 200, None
+
+
+class MockServer(ThreadingHTTPServer):
+    """Threaded mock mob-edu server.
+
+        with MockServer(latency=0.005) as server:
+            controller = Controller(server.url)
+            controller.authenticate(*server.credentials)
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503,
+                 credentials=('admin', 'admin'), state=None, seed=None, session_ttl=None):
+        """
+            :param latency: seconds added to every request
+            :param jitter: up to this many seconds more, uniformly random
+            :param error_rate: share of requests (except authentication) answered with error_status
+                               without doing anything
+            :param state: MockState to serve, e.g. one prepared by the caller
+            :param session_ttl: seconds a session is valid for, forever by default
+
+        """
+        super(MockServer, self).__init__((host, port), MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.credentials = tuple(credentials)
+        self.state = state if state is not None else MockState()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._thread = None
+        self.session_ttl = session_ttl
+        self._sessions = {}
+        self._session_count = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def delay(self):
+        seconds = self.latency
+        if self.jitter:
+            with self._random_lock:
+                seconds += self._random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def new_session(self):
+        with self._random_lock:
+            self._session_count += 1
+            session = 'mock-{}'.format(self._session_count)
+            self._sessions[session] = time.monotonic() + self.session_ttl if self.session_ttl else None
+        return session
+
+    def valid_session(self, cookie_header):
+        for cookie in (cookie_header or '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == SESSION_COOKIE:
+                with self._random_lock:
+                    expires = self._sessions.get(value, 0)
+                return expires is None or expires > time.monotonic()
+        return False
+
+    def expire_sessions(self):
+        """Make every session given out so far invalid."""
+        with self._random_lock:
+            self._sessions.clear()
+
+    @property
+    def request_count(self):
+        with self.state.lock:
+            return sum(self.state.requests.values())
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency, up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--session-ttl', type=float, default=None, help="seconds a session is valid for")
+    args = parser.parse_args()
+    server = MockServer(args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        error_status=args.error_status, credentials=(args.username, args.password),
+                        session_ttl=args.session_ttl)
+    print("Serving a mock mob-edu on {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()